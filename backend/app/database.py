@@ -1,5 +1,6 @@
 from contextlib import asynccontextmanager
 import logging
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
@@ -9,6 +10,7 @@ from dotenv import load_dotenv
 # Загрузка переменных окружения из .env
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'app', '.env')
 load_dotenv(dotenv_path)
+from app.roles import role_setting  # После .env: роль процесса может быть задана там
 # Отключаем информационные логи SQLAlchemy
 # Отключаем SQLAlchemy INFO-логи
 logging.getLogger("sqlalchemy.engine").setLevel(logging.ERROR)
@@ -32,8 +34,38 @@ if not DATABASE_URL:
 # Строка подключения для asyncpg
 DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
 
+# Настройки пула соединений (у каждой роли процесса могут быть свои: DB_API_POOL_SIZE, DB_BOT_POOL_SIZE, ...)
+DB_POOL_SIZE = int(role_setting("POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(role_setting("MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = int(role_setting("POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # секунды; закрываем соединения старше получаса
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+# Кэш подготовленных выражений: у нас небольшой набор часто повторяющихся запросов,
+# поэтому держим их подготовленными на каждом соединении
+DB_PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", 500))  # кэш SQLAlchemy (asyncpg dialect)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))  # собственный кэш asyncpg
+DB_MAX_CACHEABLE_STATEMENT_SIZE = int(os.getenv("DB_MAX_CACHEABLE_STATEMENT_SIZE", 64 * 1024))
+
+_url = make_url(DATABASE_URL).update_query_dict(
+    {"prepared_statement_cache_size": str(DB_PREPARED_STATEMENT_CACHE_SIZE)}
+)
+
 # Создаем асинхронный движок SQLAlchemy
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
+engine = create_async_engine(
+    _url,
+    echo=False,
+    future=True,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+    connect_args={
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "max_cacheable_statement_size": DB_MAX_CACHEABLE_STATEMENT_SIZE,
+    },
+)
 
 # Создаем асинхронный sessionmaker для SQLAlchemy
 AsyncSessionLocal = sessionmaker(
@@ -60,3 +92,30 @@ async def get_db():
         finally:
             # Гарантируем, что сессия будет закрыта
             await db.close()
+
+
+async def get_session():
+    """Зависимость FastAPI: одна короткоживущая сессия на запрос."""
+    async with get_db() as db:
+        yield db
+
+
+@asynccontextmanager
+async def unit_of_work():
+    """Короткая единица работы для фоновых задач: коммит при успехе, откат при ошибке, затем закрытие."""
+    async with get_db() as db:
+        yield db
+        await db.commit()
+
+
+def pool_status() -> dict:
+    """Статистика пула соединений для метрик."""
+    pool = engine.pool
+    return {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "status": pool.status(),
+    }
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import os
+from app.database import get_db, unit_of_work  # Сессии: на запрос и на одну итерацию фоновой задачи
+from app.roles import APP_ROLE, runs
+from app.services.signals import process_signals, create_static_signals, current_moscow_time
+from app.services.scheduler import signal_scheduler, SETTLE, AUTO_MODE, JOIN_CLOSED, RELOAD, SCHEDULER_RELOAD_INTERVAL
+from app.services.signal_feed import signal_feed
+from app.services.auto_mode import process_auto_mode_users
+from app.services.schema import ensure_schema
+from app.services.cache_bus import CACHE_BUS, cache_bus
+from app.telegram_bot import main as start_telegram_bot
+from app.statistics_services.ledger import LEDGER_MODE, async_writer as ledger_writer
+from app.services.join_admission import JOIN_ADMISSION_QUEUE, join_admission
+from app.services.token_store import token_store
+from app.services.signed_tokens import AUTH_MODE
+
+# Период цикла автомода (дополнительно он запускается при появлении каждого нового сигнала)
+AUTO_MODE_INTERVAL = int(os.getenv("AUTO_MODE_INTERVAL", 60))
+
+# Долгоживущие задачи процесса, которые нужно остановить при выключении
+background_tasks = {}
+
+
+async def start_services():
+    """Запуск фоновых процессов роли APP_ROLE (all — все роли в одном процессе)."""
+    logging.info(f"Запуск фоновых задач роли {APP_ROLE}.")
+    signal_scheduler.configure(clock=current_moscow_time)  # Те же часы, что now() в запросах входа и ленты
+    async with get_db() as db:
+        await ensure_schema(db)  # Недостающие индексы
+        if runs("scheduler"):
+            await create_static_signals(db)  # Генерация статичных сигналов
+        if runs("api") and AUTH_MODE == "store":
+            await token_store.load(db)  # Действующие токены входа в память
+
+    # Инвалидация кэшей между процессами (роли в разных процессах)
+    if CACHE_BUS:
+        cache_bus.start()
+
+    # Фоновый писатель журнала транзакций (в режиме LEDGER_MODE=async)
+    if LEDGER_MODE == "async":
+        ledger_writer.start()
+
+    if runs("api"):
+        # Очередь допуска входов в сигналы (JOIN_ADMISSION_QUEUE)
+        if JOIN_ADMISSION_QUEUE:
+            join_admission.start()
+
+        # Очистка просроченных токенов входа
+        token_store.start()
+
+    if runs("bot"):
+        background_tasks["bot"] = asyncio.create_task(start_telegram_bot())  # Telegram бот (BOT_MODE)
+
+    if runs("scheduler"):
+        # Сигналы, созданные в API-процессах, сразу попадают в планировщик (страховка — задача RELOAD)
+        cache_bus.on("signal_created", signal_scheduler.on_signal_created)
+        background_tasks["scheduler"] = asyncio.create_task(run_background_tasks())  # Сигналы + авто-режим
+
+
+async def stop_services():
+    """Останавливаем бота и планировщик, применяем оставшиеся входы в сигналы и дописываем журнал транзакций."""
+    bot_task = background_tasks.pop("bot", None)
+    if bot_task is not None:
+        bot_task.cancel()  # Бот останавливает опрос и освобождает блокировку опрашивающего процесса
+        await asyncio.gather(bot_task, return_exceptions=True)
+    scheduler_task = background_tasks.pop("scheduler", None)
+    if scheduler_task is not None:
+        scheduler_task.cancel()
+        await asyncio.gather(scheduler_task, return_exceptions=True)
+    await join_admission.stop()
+    await ledger_writer.stop()
+    await token_store.stop()
+    await cache_bus.stop()
+
+
+async def run_background_tasks():
+    """Запуск планировщика сигналов: задачи выполняются ровно к своим дедлайнам."""
+    signal_scheduler.on(SETTLE, process_signals_task)
+    signal_scheduler.on(AUTO_MODE, run_auto_mode)
+    signal_scheduler.on(JOIN_CLOSED, refresh_signal_feed)
+    signal_scheduler.on(RELOAD, reload_pending_signals)
+
+    await load_pending_signals()
+    signal_scheduler.schedule_in(0, AUTO_MODE)
+    signal_scheduler.schedule_in(SCHEDULER_RELOAD_INTERVAL, RELOAD)
+    await signal_scheduler.run()
+
+
+async def load_pending_signals():
+    async with unit_of_work() as db:
+        await signal_scheduler.load_pending(db)
+
+
+async def reload_pending_signals(signal_ids):
+    """Перечитывание сигналов из БД раз в SCHEDULER_RELOAD_INTERVAL секунд (таймеры уже известных не дублируются)."""
+    try:
+        await load_pending_signals()
+    finally:
+        signal_scheduler.schedule_in(SCHEDULER_RELOAD_INTERVAL, RELOAD)
+
+
+async def refresh_signal_feed(signal_ids):
+    """Окно входа в сигнал закрылось — снимок активных сигналов устарел."""
+    signal_feed.invalidate()
+
+
+async def process_signals_task(signal_ids):
+    """Обработка истёкших сигналов (вызывается планировщиком при наступлении expires_at)."""
+    async with unit_of_work() as db:  # Новая короткая сессия на каждый запуск
+        await process_signals(db)
+
+async def run_auto_mode(signal_ids):
+    """Обработка пользователей с авто-режимом: при появлении нового сигнала и не реже раза в AUTO_MODE_INTERVAL секунд."""
+    try:
+        async with unit_of_work() as db:  # Новая короткая сессия на каждый запуск
+            await process_auto_mode_users(db)  # Обрабатываем пользователей с авто-режимом
+    finally:
+        signal_scheduler.schedule_in(AUTO_MODE_INTERVAL, AUTO_MODE)
@@ -1,13 +1,10 @@
 from fastapi import FastAPI, HTTPException
-import asyncio
-import nest_asyncio
-from app.database import get_db  # Импортируем функцию для получения сессии
-from app.services.signals import process_signals, create_static_signals
-from app.services.auto_mode import process_auto_mode_users
-from app.routers import users, balances, signals_routes, general_routes  # Подключаем роутеры
-from app.telegram_bot import main as start_telegram_bot
+from app.routers import users, balances, signals_routes, general_routes, telegram_webhook  # Подключаем роутеры
+from app.lifecycle import start_services, stop_services
+from app.roles import runs
 from fastapi.middleware.cors import CORSMiddleware
 import logging
+import os
 
 # Отключаем SQLAlchemy INFO-логи
 logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
@@ -27,8 +24,6 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(formatter)
 
 logger.addHandler(console_handler)
-# Применяем nest_asyncio для корректной работы event loop
-nest_asyncio.apply()
 #logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
 
 app = FastAPI()
@@ -46,6 +41,7 @@ app.add_middleware(
     allow_credentials=True,  
     allow_methods=["*"],  
     allow_headers=["*"],  
+    expose_headers=["X-Next-Cursor", "ETag"],  # Курсор следующей страницы истории и версия ленты сигналов
 )
 
 # Подключаем маршруты
@@ -53,54 +49,23 @@ app.include_router(users.router)
 app.include_router(balances.router)
 app.include_router(signals_routes.signalis_router)
 app.include_router(general_routes.router)
+if runs("bot"):
+    app.include_router(telegram_webhook.router)  # Обновления Telegram принимает процесс с ботом
 
-@app.on_event("startup")
 @app.on_event("startup")
 async def startup_event():
-    """Запуск фоновых процессов при старте приложения."""
+    """Запуск фоновых процессов при старте приложения (по роли процесса APP_ROLE)."""
     try:
-        logging.info("Запуск фоновых задач.")
-        async with get_db() as db:
-            await create_static_signals(db)  # Генерация статичных сигналов
-        
-        # Запуск всех задач одновременно
-        asyncio.create_task(start_telegram_bot())  # Telegram бот
-        asyncio.create_task(run_background_tasks())  # Фоновые задачи (сигналы + авто-режим)
-        
+        await start_services()
     except Exception as e:
         logging.error(f"Ошибка при запуске фоновых задач: {e}")
         raise HTTPException(status_code=500, detail="Ошибка при запуске фоновых задач")
 
 
-async def run_background_tasks():
-    """Запуск всех фоновых задач в одном процессе."""
-    await asyncio.gather(process_signals_task(), run_auto_mode())  # Параллельный запуск
-
-
-
-
-async def process_signals_task():
-    """Фоновая задача для обработки сигналов каждые 60 секунд."""
-    async with get_db() as db:  # Открываем сессию один раз
-        while True:
-            try:
-                await process_signals(db)  # Переиспользуем сессию
-                await asyncio.sleep(60)
-            except Exception as e:
-                logging.error(f"Ошибка при обработке сигналов: {e}")
-                await asyncio.sleep(10)  
-            
-async def run_auto_mode():
-    """Фоновый процесс для обработки пользователей с авто-режимом каждые 60 секунд."""
-    while True:
-        try:
-            async with get_db() as db:  # Получаем сессию через get_db
-                await process_auto_mode_users(db)  # Обрабатываем пользователей с авто-режимом
-        except Exception as e:
-            logging.error(f"Ошибка при обработке авто-режима: {e}")
-        await asyncio.sleep(60)  # Асинхронная задержка 60 секунд
-
-
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Применяем оставшиеся входы в сигналы и дописываем журнал транзакций перед остановкой."""
+    await stop_services()
 
 
 @app.get("/")
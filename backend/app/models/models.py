@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Double, Integer, Float, ForeignKey, Numeric, String, Boolean, TIMESTAMP, BigInteger, DateTime
+from sqlalchemy import Column, Double, Integer, Float, ForeignKey, Numeric, String, Boolean, TIMESTAMP, BigInteger, DateTime, UniqueConstraint
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -79,7 +79,8 @@ class Referrals(Base):
     referral_link = Column(String, nullable=False)
     invited_count = Column(Integer, default=0)
     referrer_id = Column(BigInteger, ForeignKey('users.telegram_id'), nullable=True)
-    referred_by = Column(BigInteger, ForeignKey('users.id'), nullable=True)
+    referred_by = Column(BigInteger, ForeignKey('users.telegram_id', name='fk_referrals_referred_by_telegram_id'),
+                         nullable=True, index=True)  # Telegram ID пригласившего
     
     # Связь с пользователем (тот, кто был приглашен)
     user = relationship("User", foreign_keys=[user_id], back_populates="referrals")
@@ -88,6 +89,15 @@ class Referrals(Base):
     referrer = relationship("User", foreign_keys=[referrer_id], back_populates="referred_by")
 
 
+class ReferralClosure(Base):
+    """Все пары (предок, потомок) дерева рефералов по telegram_id; depth = 0 — сам пользователь."""
+    __tablename__ = 'referral_closure'
+
+    ancestor = Column(BigInteger, primary_key=True)
+    descendant = Column(BigInteger, primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
+
 class Signal(Base):
     __tablename__ = 'signals'
 
@@ -101,9 +111,13 @@ class Signal(Base):
     investments = relationship("SignalInvestment", back_populates="signal")
     signal_cost = Column(Integer, nullable=False)
     success_profit_multiplier = Column(Float, nullable=False, default=1.01)  # ✅ Новый столбец
+    outcome_seed = Column(BigInteger, nullable=True)  # Seed генератора исхода (для повторного расчёта)
 
 class SignalInvestment(Base):
     __tablename__ = 'signal_investments'
+    __table_args__ = (
+        UniqueConstraint('signal_id', 'user_id', name='uq_signal_investments_signal_user'),  # Один вход в сигнал
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     signal_id = Column(Integer, ForeignKey('signals.id', ondelete='CASCADE'), nullable=False)
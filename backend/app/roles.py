@@ -0,0 +1,22 @@
+import os
+
+# Роль процесса: all — API, бот и планировщик в одном процессе (как раньше);
+# api / bot / scheduler — отдельные процессы (см. app/worker.py), каждый со своим пулом соединений.
+# При разнесённых ролях процессы связаны шиной cache_bus (CACHE_BUS): в том числе сигнал, созданный в API,
+# сообщением signal_created сразу ставится в планировщик; RELOAD раз в SCHEDULER_RELOAD_INTERVAL —
+# страховка на случай потерянного сообщения.
+APP_ROLE = os.getenv("APP_ROLE", "all").lower()
+APP_ROLES = ("all", "api", "bot", "scheduler")
+
+if APP_ROLE not in APP_ROLES:
+    raise ValueError(f"Неизвестная роль APP_ROLE={APP_ROLE}, допустимы: {', '.join(APP_ROLES)}")
+
+
+def runs(role: str) -> bool:
+    """Выполняет ли текущий процесс роль role."""
+    return APP_ROLE in ("all", role)
+
+
+def role_setting(name: str, default):
+    """Настройка с переопределением для роли: DB_BOT_POOL_SIZE важнее DB_POOL_SIZE."""
+    return os.getenv(f"DB_{APP_ROLE.upper()}_{name}", os.getenv(f"DB_{name}", default))
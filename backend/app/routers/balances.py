@@ -2,19 +2,16 @@ import logging
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
-from app.services.get_db import get_db  # Импортируем get_db
+from app.database import get_session  # Сессия на запрос
 from app.models.models import Referrals, User, Balance 
+from app.services.user_cache import get_user_ref
+from app.services.read_models import get_balance_view
 from app.services.balances import (
-    has_sufficient_trading_balance,
-    update_balance, 
-    has_sufficient_balance,
+    mutate_balance,  # 🔹 Атомарное изменение баланса
     get_balance,
     update_referral_by_url,
-    update_trading_balance,
-    freeze_balance,  # 🔹 Функция заморозки
-    unfreeze_balance  # 🔹 Функция разблокировки
+    transfer_balance,  # 🔹 Атомарный перевод между балансами
+    BalanceLeg
 )
 #-------------------------------------------------------------------------#   
 router = APIRouter(prefix="/api")
@@ -31,11 +28,8 @@ logging.getLogger('sqlalchemy.engine').setLevel(logging.ERROR)
 #-------------------------------------------------------------------------#   
 
 @router.get("/balance/{telegram_id}")
-async def get_balance_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(
-        select(User).options(joinedload(User.balance)).filter(User.telegram_id == telegram_id)
-    )
-    user = result.scalars().first()
+async def get_balance_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_session)):
+    user = await get_balance_view(db, telegram_id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -43,122 +37,110 @@ async def get_balance_by_telegram_id(telegram_id: int, db: AsyncSession = Depend
     return {
         "id": user.id,
         "telegram_id": user.telegram_id,
-        "balance": user.balance.balance if user.balance else 0.0,
-        "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-        "frozen_balance": user.balance.frozen_balance if user.balance else 0.0
+        "balance": user.balance or 0.0,
+        "trade_balance": user.trade_balance or 0.0,
+        "frozen_balance": user.frozen_balance or 0.0
     }
 
 #-------------------------------------------------------------------------#   
 
 @router.post("/transfer_to_trading/{telegram_id}")
-async def transfer_to_trading(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
+async def transfer_to_trading(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_session)):
     amount = request.amount
 
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
 
-    result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-    user = result.scalars().first()
+    user = await get_user_ref(db, telegram_id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if await has_sufficient_balance(db, user.id, amount):
-        if await update_balance(db, user.id, -amount):
-            if await update_trading_balance(db, user.id, amount):
-                await freeze_balance(db, user.id, amount)
-                return {"message": "Transfer successful, funds frozen"}
+    # Перевод на торговый баланс и заморозка — одним атомарным запросом
+    snapshot = await transfer_balance(db, user.id, [
+        BalanceLeg("balance", "trade_balance", amount, "transfer_to_trade"),
+        BalanceLeg("balance", "frozen_balance", amount, "freeze", optional=True),
+    ])
+    if snapshot:
+        return {"message": "Transfer successful, funds frozen"}
 
     raise HTTPException(status_code=400, detail="Insufficient balance")
 
 #-------------------------------------------------------------------------#   
 
 @router.get("/unfreeze_balance/{telegram_id}")
-async def unfreeze(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-    user = result.scalars().first()
+async def unfreeze(telegram_id: int, db: AsyncSession = Depends(get_session)):
+    user = await get_user_ref(db, telegram_id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    balance_result = await db.execute(select(Balance).filter(Balance.user_id == user.id))
-    balance = balance_result.scalars().first()
+    balance = await get_balance(db, user.id)
 
     if not balance or balance.frozen_balance <= 0:
         raise HTTPException(status_code=400, detail="No frozen balance to unfreeze")
 
+    # Переносится прочитанная сумма; условие перевода не даст разморозить больше, чем заморожено сейчас
     amount_to_unfreeze = balance.frozen_balance
-    balance.trade_balance += amount_to_unfreeze
-    balance.frozen_balance = 0
-
-    await db.commit()
+    snapshot = await transfer_balance(db, user.id, [
+        BalanceLeg("frozen_balance", "trade_balance", amount_to_unfreeze, "unfreeze"),
+    ])
+    if snapshot is None:
+        raise HTTPException(status_code=400, detail="No frozen balance to unfreeze")
 
     return {
         "message": "Balance unfrozen",
         "unfrozen_amount": amount_to_unfreeze,
-        "new_trade_balance": balance.trade_balance
+        "new_trade_balance": snapshot.trade_balance
     }
 
 #-------------------------------------------------------------------------#   
 
 @router.post("/deposit/{telegram_id}")
-async def deposit(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
+async def deposit(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_session)):
     amount = request.amount
     
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
 
-    result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-    user = result.scalar_one_or_none()
+    user = await get_user_ref(db, telegram_id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    balance = await get_balance(db, user.id)
-    if balance is None:
+    # Зачисление и запись в журнал одним запросом; он же возвращает новый баланс
+    snapshot = await mutate_balance(db, user.id, {"balance": amount}, "balance_update")
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="Balance not found")
 
-    success = await update_balance(db, user.id, amount)
-
-    if success:
-        updated_balance = await get_balance(db, user.id)
-        return {"message": "Deposit successful", "new_balance": updated_balance.balance}
-
-    raise HTTPException(status_code=500, detail="Failed to update balance")
+    return {"message": "Deposit successful", "new_balance": snapshot.balance}
 
 #-------------------------------------------------------------------------#   
 
 @router.post("/transfer_to_main/{telegram_id}")
-async def transfer_to_main(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_db)):
+async def transfer_to_main(telegram_id: int, request: AmountRequest, db: AsyncSession = Depends(get_session)):
     amount = request.amount
 
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Amount must be greater than zero")
 
-    result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-    user = result.scalars().first()
+    user = await get_user_ref(db, telegram_id)
 
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    if await has_sufficient_trading_balance(db, user.id, amount):
-        if await update_trading_balance(db, user.id, -amount):
-            if await update_balance(db, user.id, amount):
-                result = await db.execute(
-                    select(User).options(joinedload(User.balance)).filter(User.telegram_id == telegram_id)
-                )
-                user = result.scalars().first()
-
-                if user is None:
-                    raise HTTPException(status_code=404, detail="User not found")
-
-                return {
-                    "id": user.id,
-                    "telegram_id": user.telegram_id,
-                    "balance": user.balance.balance if user.balance else 0.0,
-                    "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-                    "frozen_balance": user.balance.frozen_balance if user.balance else 0.0
-                }
+    # Перевод возвращает итоговый снимок баланса — повторный запрос не нужен
+    snapshot = await transfer_balance(db, user.id, [
+        BalanceLeg("trade_balance", "balance", amount, "transfer_to_main"),
+    ])
+    if snapshot:
+        return {
+            "id": user.id,
+            "telegram_id": user.telegram_id,
+            "balance": snapshot.balance,
+            "trade_balance": snapshot.trade_balance,
+            "frozen_balance": snapshot.frozen_balance
+        }
 
     raise HTTPException(status_code=400, detail="Insufficient trading balance")
 
@@ -1,13 +1,22 @@
 import logging
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete
 from sqlalchemy.future import select
 from app.models.models import AuthTokens, User
-from app.services.get_db import get_db
-from datetime import datetime, timezone
+from app.database import get_session  # Сессия на запрос
 from tzlocal import get_localzone
-from sqlalchemy.orm import subqueryload
-from app.database import get_db as main
+from app.database import get_db as main, pool_status
+from app.services import settlement
+from app.services.scheduler import signal_scheduler
+from app.services.user_cache import user_cache
+from app.services.signal_feed import signal_feed
+from app.services.join_admission import join_admission
+from app.services.read_models import get_user_view, referrer_dict
+from app.services.token_store import token_store, validate_token
+from app.services.cache_bus import cache_bus
+from app.services.signed_tokens import AUTH_MODE, revocations, revoke_signed_token, verify_signed_token
+from app.statistics_services import ledger
 
 # Отключаем SQLAlchemy INFO-логи
 logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
@@ -33,51 +42,57 @@ router = APIRouter(prefix="/api")
 #-------------------------------------------------------------------------#   
 
 @router.get("/auth")
-async def auth_with_token(token: str, db: AsyncSession = Depends(get_db)):
+async def auth_with_token(token: str, db: AsyncSession = Depends(get_session)):
     """Проверка токена и вход в систему"""
     
-    result = await db.execute(select(AuthTokens).filter(AuthTokens.token == token))
-    auth_token = result.scalars().first()
+    if AUTH_MODE == "signed":
+        auth = verify_signed_token(token)  # Подпись и срок — без обращения к базе
+    else:
+        auth = await validate_token(db, token)  # Из памяти; в базу — только при промахе
 
-    if not auth_token:
-        logging.warning(f"Токен {token} не найден в базе данных")
+    if not auth:
+        logging.warning(f"Токен {token} не найден или просрочен")
         raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
 
-    if auth_token.expires_at < datetime.now(timezone.utc):
-        logging.warning(f"Токен {token} просрочен.")
-        raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
-
-    result = await db.execute(select(User).filter(User.telegram_id == auth_token.user_id))
-    user = result.scalars().first()
-
-    if not user:
-        logging.warning(f"Пользователь с ID {auth_token.user_id} не найден в базе данных")
+    if auth.telegram_id is None:
+        logging.warning(f"Пользователь для токена {token} не найден в базе данных")
         raise HTTPException(status_code=404, detail="Пользователь не найден")
 
     local_tz = get_localzone()
-    expires_at_local = auth_token.expires_at.astimezone(local_tz)
+    expires_at_local = auth.expires_at.astimezone(local_tz)
 
     return {
-        "telegram_id": user.telegram_id,
-        "username": user.username,
+        "telegram_id": auth.telegram_id,
+        "username": auth.username,
         "message": "Успешный вход!",
         "token_expires_at": expires_at_local.strftime("%Y-%m-%d %H:%M:%S %z")
     }
 
 #-------------------------------------------------------------------------#   
 
+@router.post("/logout")
+async def logout(token: str, db: AsyncSession = Depends(get_session)):
+    """Выход: токен входа становится недействительным"""
+    if AUTH_MODE == "signed":
+        revoked = revoke_signed_token(token)
+    else:
+        result = await db.execute(delete(AuthTokens).where(AuthTokens.token == token))
+        await db.commit()
+        token_store.discard(token)
+        cache_bus.publish("auth_token", token)
+        revoked = result.rowcount > 0
+
+    if not revoked:
+        raise HTTPException(status_code=403, detail="Недействительный или просроченный токен")
+
+    return {"message": "Вы вышли из системы"}
+
+#-------------------------------------------------------------------------#   
+
 @router.get("/user/{telegram_id}")
-async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_session)):
     try:
-        result = await db.execute(
-            select(User)
-            .options(
-                subqueryload(User.balance),
-                subqueryload(User.referred_by)
-            )
-            .filter(User.telegram_id == telegram_id)
-        )
-        user = result.scalars().first()
+        user = await get_user_view(db, telegram_id)
 
         if not user:
             logging.warning(f"Пользователь с telegram_id {telegram_id} не найден.")
@@ -94,13 +109,9 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
             "photo_url": user.photo_url,
             "created_at": user.created_at,
             "updated_at": user.updated_at,
-            "balance": user.balance.balance if user.balance else 0.0,
-            "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-            "referred_by": {
-                "id": user.referred_by.id if user.referred_by else None,
-                "telegram_id": user.referred_by.telegram_id if user.referred_by else None,
-                "username": user.referred_by.username if user.referred_by else None
-            } if user.referred_by else None
+            "balance": user.balance or 0.0,
+            "trade_balance": user.trade_balance or 0.0,
+            "referred_by": referrer_dict(user)
         }
 
     except HTTPException:
@@ -113,7 +124,7 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
 #-------------------------------------------------------------------------#   
 
 @router.put("/user/{telegram_id}/update_reinvestments")
-async def update_reinvestments(telegram_id: int, new_value: int, db: AsyncSession = Depends(get_db)):
+async def update_reinvestments(telegram_id: int, new_value: int, db: AsyncSession = Depends(get_session)):
     """
     Обновляет параметр reinvestements_par для пользователя с указанным telegram_id.
     Разрешает устанавливать только значения 0, 25, 50, 75, 100.
@@ -147,4 +158,22 @@ async def update_reinvestments(telegram_id: int, new_value: int, db: AsyncSessio
         logging.error(f"Ошибка при обновлении reinvestements_par у пользователя {telegram_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+#-------------------------------------------------------------------------#
+
+@router.get("/metrics")
+async def get_metrics():
+    """Метрики фоновых подсистем (журнал транзакций, обработка сигналов, планировщик, пул соединений, кэши, очередь входов, токены входа)"""
+    return {
+        "ledger": ledger.get_metrics(),
+        "settlement": settlement.last_batch_stats,
+        "scheduler": signal_scheduler.get_metrics(),
+        "db_pool": pool_status(),
+        "user_cache": user_cache.get_metrics(),
+        "signal_feed": signal_feed.get_metrics(),
+        "join_admission": join_admission.get_metrics(),
+        "auth_tokens": token_store.get_metrics(),
+        "token_revocations": revocations.get_metrics(),
+        "cache_bus": cache_bus.get_metrics(),
+    }
+
 #-------------------------------------------------------------------------#   
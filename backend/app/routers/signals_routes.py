@@ -2,15 +2,21 @@ from datetime import datetime, timedelta
 import logging
 import os
 import random
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
 from sqlalchemy.future import select
 from sqlalchemy.sql import func
-from app.services.get_db import get_db  # Импортируем get_db
-from app.models.models import User, Balance, Signal, SignalInvestment
-from app.services.balances import freeze_balance, update_trading_balance
+from app.database import get_session  # Сессия на запрос
+from app.models.models import User, Signal, SignalInvestment
+from app.services.balances import get_balance, mutate_balance
 from app.services.signals import create_signal  # Импортируем метод создания сигнала
+from app.services.user_cache import get_user_ref, invalidate_user
+from app.services.signal_feed import signal_feed
+from app.services.history import NEXT_CURSOR_HEADER, fetch_history_page, stream_history
+from app.services.join_admission import JOIN_ADMISSION_QUEUE, build_join_response, join_admission
 
 # Отключаем SQLAlchemy INFO-логи
 logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
@@ -63,89 +69,109 @@ class RandomSignalRequest(BaseModel):
 # Минимальное время блокировки перед выходом (3 минуты)
 MIN_LOCK_PERIOD_MINUTES = 3
 
+# Вход в сигнал одним запросом. Инвестиция вставляется, только если сигнал открыт, средств хватает
+# и пары (signal_id, user_id) ещё нет (уникальный индекс закрывает гонку параллельных запросов);
+# списание — условный UPDATE под блокировкой строки баланса; in_work растёт только вместе со вставкой.
+_JOIN_SIGNAL = text("""
+    WITH sig AS (
+        SELECT id, signal_cost
+        FROM signals
+        WHERE id = CAST(:signal_id AS INTEGER) AND join_until > now() AND is_successful IS NULL
+    ),
+    bal AS (
+        SELECT trade_balance
+        FROM balances
+        WHERE user_id = CAST(:user_id AS INTEGER)
+        ORDER BY id
+        LIMIT 1
+    ),
+    existing AS (
+        SELECT 1
+        FROM signal_investments
+        WHERE signal_id = CAST(:signal_id AS INTEGER) AND user_id = CAST(:user_id AS INTEGER)
+        LIMIT 1
+    ),
+    inv AS (
+        INSERT INTO signal_investments (signal_id, user_id, amount, auto_mode, is_checked)
+        SELECT sig.id, CAST(:user_id AS INTEGER), sig.signal_cost, FALSE, FALSE
+        FROM sig, bal
+        WHERE bal.trade_balance >= sig.signal_cost
+          AND NOT EXISTS (SELECT 1 FROM existing)
+        ON CONFLICT DO NOTHING
+        RETURNING amount
+    ),
+    debited AS (
+        UPDATE balances AS b
+        SET trade_balance = b.trade_balance - inv.amount
+        FROM inv
+        WHERE b.user_id = CAST(:user_id AS INTEGER) AND b.trade_balance >= inv.amount
+        RETURNING b.user_id
+    ),
+    work AS (
+        UPDATE users AS u
+        SET in_work = u.in_work + 1
+        FROM inv
+        WHERE u.id = CAST(:user_id AS INTEGER)
+        RETURNING u.id
+    )
+    SELECT
+        EXISTS (SELECT 1 FROM existing) AS already_joined,
+        (SELECT signal_cost FROM sig) AS signal_cost,
+        (SELECT trade_balance FROM bal) AS trade_balance,
+        EXISTS (SELECT 1 FROM inv) AS inserted,
+        EXISTS (SELECT 1 FROM debited) AS debited
+""")
+
+# Инвестиция автомода при включении; уже существующая пара (signal_id, user_id) не даёт строки — без списания
+_INSERT_AUTO_MODE_INVESTMENT = text("""
+    INSERT INTO signal_investments (signal_id, user_id, amount, auto_mode, is_checked)
+    VALUES (CAST(:signal_id AS INTEGER), CAST(:user_id AS INTEGER), CAST(:amount AS DOUBLE PRECISION), TRUE, FALSE)
+    ON CONFLICT (signal_id, user_id) DO NOTHING
+    RETURNING id
+""")
+
 #-------------------------------------------------------------------------#   
 
 @signalis_router.post("/join")
-async def join_signal(request: JoinSignalRequest, db: AsyncSession = Depends(get_db)):
+async def join_signal(request: JoinSignalRequest, db: AsyncSession = Depends(get_session)):
     """ 
     Пользователь входит в сигнал. Средства списываются с торгового баланса 
     и фиксируются в инвестициях. 
+
+    Проверки, инвестиция, списание и счётчик in_work — одним запросом (_JOIN_SIGNAL)
+    или пакетом через очередь допуска (JOIN_ADMISSION_QUEUE).
     """
     telegram_id = request.telegram_id
     signal_id = request.signal_id
 
     try:
         # Получаем пользователя
-        user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-        user = user_result.scalars().first()
+        user = await get_user_ref(db, telegram_id)
         if not user:
             return {"message": "User not found", "success": False}
 
-        # Проверяем, не заходил ли пользователь уже в этот сигнал
-        existing_investment = await db.execute(
-            select(SignalInvestment).filter(
-                SignalInvestment.user_id == user.id,
-                SignalInvestment.signal_id == signal_id
-            )
-        )
-        if existing_investment.scalars().first():
-            return {"message": "User has already joined this signal", "success": False}
-
-        # Получаем баланс пользователя
-        balance_result = await db.execute(select(Balance).filter(Balance.user_id == user.id))
-        balance = balance_result.scalars().first()
-        if not balance:
-            return {"message": "Balance not found", "success": False}
-
-        # Проверяем доступность сигнала
-        signal_result = await db.execute(select(Signal).filter(Signal.id == signal_id, Signal.join_until > func.now()))
-        signal = signal_result.scalars().first()
-
-        # Если сигнал не доступен
-        if not signal:
-            return {
-                "message": "Signal is not available for joining",
-                "success": False,
-                "server_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                "signal_join_until": signal.join_until.strftime("%Y-%m-%d %H:%M:%S") if signal else "N/A"
-            }
-
-        # Получаем стоимость входа
-        signal_cost = signal.signal_cost
+        # Под нагрузкой входы применяются пакетами через очередь допуска
+        if JOIN_ADMISSION_QUEUE:
+            # Соединение запроса возвращается в пул до ожидания пакета — пакет берёт своё
+            await db.close()
+            return await join_admission.submit(user.id, signal_id)
 
-        # Проверяем баланс
-        if balance.trade_balance < signal_cost:
-            return {
-                "message": "Insufficient trading balance for signal cost",
-                "success": False,
-                "required_amount": signal_cost,
-                "current_balance": balance.trade_balance
-            }
-
-        # Вычитаем сумму с торгового баланса
-        balance.trade_balance -= signal_cost
+        result = await db.execute(_JOIN_SIGNAL, {"signal_id": signal_id, "user_id": user.id})
+        joined = result.one()
 
-        # Увеличиваем количество активных сигналов у пользователя
-        user.in_work += 1
+        # Если условное списание не прошло (баланс успели уменьшить параллельно), откатываем и инвестицию
+        if joined.inserted and joined.debited:
+            await db.commit()
+        else:
+            await db.rollback()
 
-        # Сохраняем инвестицию
-        investment = SignalInvestment(
-            signal_id=signal_id,
-            user_id=user.id,
-            amount=signal_cost,
+        return build_join_response(
+            signal_id, joined.already_joined, joined.signal_cost, joined.trade_balance,
+            joined.inserted, joined.debited
         )
-        db.add(investment)
-
-        await db.commit()
-
-        return {
-            "message": "Successfully joined the signal",
-            "success": True,
-            "signal_id": signal_id,
-            "amount": signal_cost
-        }
 
     except Exception as e:
+        await db.rollback()
         logging.error(f"Error while joining signal: {str(e)}")
         return {"message": "An error occurred while joining the signal", "success": False}
 
@@ -158,7 +184,7 @@ class RandomSignalRequest(BaseModel):
     name: str
 
 @signalis_router.post("/create_random")
-async def create_random_signal(request: RandomSignalRequest, db: AsyncSession = Depends(get_db)):
+async def create_random_signal(request: RandomSignalRequest, db: AsyncSession = Depends(get_session)):
     """Создает случайный сигнал со случайными параметрами (время до входа, продолжительность, шанс сгорания, процент прибыли, цена входа)."""
     name = request.name
 
@@ -196,7 +222,7 @@ async def create_random_signal(request: RandomSignalRequest, db: AsyncSession =
 #-------------------------------------------------------------------------#   
 
 @signalis_router.post("/create_custom")
-async def create_custom_signal(request: CustomSignalRequest, db: AsyncSession = Depends(get_db)):
+async def create_custom_signal(request: CustomSignalRequest, db: AsyncSession = Depends(get_session)):
     """Создает сигнал с пользовательскими параметрами (время до входа, продолжительность, шанс сгорания, процент прибыли, цена входа)."""
     name = request.name
     join_time = request.join_time
@@ -238,43 +264,31 @@ async def create_custom_signal(request: CustomSignalRequest, db: AsyncSession =
 #-------------------------------------------------------------------------#   
 
 @signalis_router.get("/active")
-async def get_active_signals(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def get_active_signals(telegram_id: int, request: Request, response: Response, db: AsyncSession = Depends(get_session)):
     """ Получает список активных сигналов в зависимости от плана пользователя. """
     try:
         # Получаем пользователя по Telegram ID
-        user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-        user = user_result.scalars().first()
+        user = await get_user_ref(db, telegram_id)
         
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        # Определяем, сколько сигналов можно вернуть в зависимости от плана
-        signals_limit = {0: 2, 1: 4, 2: 5}.get(user.plan, 2)
+        # Режем общий снимок активных сигналов по плану пользователя (без запроса к БД)
+        signals_data, etag = await signal_feed.get(db, user.plan)
 
-        # Получаем активные сигналы
-        active_signals_result = await db.execute(
-            select(Signal).filter(Signal.join_until > func.now()).limit(signals_limit)
-        )
-        active_signals = active_signals_result.scalars().all()
+        # Клиент уже видел эту версию — отдаём 304 без тела
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        response.headers["ETag"] = etag
 
-        if not active_signals:
+        if not signals_data:
             return {"message": "No active signals available."}
-
-        signals_data = [
-            {
-                "signal_id": signal.id,
-                "name": signal.name,
-                "join_until": signal.join_until,
-                "burn_chance": signal.burn_chance,  # Исправлена опечатка (bur_chance → burn_chance)
-                "expires_at": signal.expires_at,
-                "signal_cost": signal.signal_cost,
-                "profit_percent": signal.profit_percent  # ✅ Добавлено отображение прибыли
-            }
-            for signal in active_signals
-        ]
         
         return {"active_signals": signals_data}
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         logging.error(f"Error retrieving active signals: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving active signals.")
@@ -282,43 +296,57 @@ async def get_active_signals(telegram_id: int, db: AsyncSession = Depends(get_db
 
 #-------------------------------------------------------------------------#   
 @signalis_router.get("/investments/{telegram_id}")
-async def get_user_investments(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def get_user_investments(
+    telegram_id: int,
+    response: Response,
+    cursor: str = None,
+    limit: int = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_session),
+):
     """
-    Ищет user_id по telegram_id, затем получает все инвестиции пользователя.
+    Ищет user_id по telegram_id, затем получает инвестиции пользователя.
+
+    Без параметров — все инвестиции; с cursor или limit — постранично по (created_at, id),
+    курсор следующей страницы — в заголовке X-Next-Cursor.
+    При stream=true все инвестиции отдаются потоком NDJSON.
     """
     # 1. Ищем user_id по telegram_id
-    user_result = await db.execute(select(User.id).filter(User.telegram_id == telegram_id))
-    user = user_result.scalar()
+    user_ref = await get_user_ref(db, telegram_id)
+    user = user_ref.id if user_ref else None
 
     if not user:
         return {"message": "Пользователь не найден"}
 
-    # 2. Ищем все инвестиции пользователя
-    investments_result = await db.execute(select(SignalInvestment).filter(SignalInvestment.user_id == user))
-    investments = investments_result.scalars().all()
+    columns = [
+        SignalInvestment.id,
+        SignalInvestment.signal_id,
+        SignalInvestment.amount,
+        SignalInvestment.profit,
+        SignalInvestment.created_at,
+    ]
+    if stream:
+        return StreamingResponse(stream_history(SignalInvestment, columns, user), media_type="application/x-ndjson")
+
+    # 2. Ищем инвестиции пользователя (все или одна страница)
+    investments, next_cursor = await fetch_history_page(db, SignalInvestment, columns, user, cursor, limit)
 
     if not investments:
         return {"message": "У пользователя нет инвестиций"}
 
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+
     # 3. Формируем ответ
     return {
         "user_id": user,
-        "investments": [
-            {
-                "id": inv.id,
-                "signal_id": inv.signal_id,
-                "amount": inv.amount,
-                "profit": inv.profit,
-                "created_at": inv.created_at,
-            }
-            for inv in investments
-        ]
+        "investments": investments
     }
 
 #-------------------------------------------------------------------------#   
 
 @signalis_router.post("/enable_automode")
-async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_session)):
     try:
         user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
         user = user_result.scalars().first()
@@ -329,12 +357,6 @@ async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
         if user.automod:
             return {"message": "Auto mode is already enabled", "success": False}
 
-        balance_result = await db.execute(select(Balance).filter(Balance.user_id == user.id))
-        balance = balance_result.scalars().first()
-
-        if not balance:
-            raise HTTPException(status_code=404, detail="Balance not found")
-
         signal_result = await db.execute(select(Signal).filter(Signal.join_until > func.now()).order_by(Signal.join_until).limit(1))
         signal = signal_result.scalars().first()
 
@@ -343,24 +365,25 @@ async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
 
         signal_cost = signal.signal_cost
 
-        if balance.trade_balance < signal_cost:
-            return {
-                "message": "Insufficient trading balance for signal cost",
-                "success": False,
-                "required_amount": signal_cost,
-                "current_balance": balance.trade_balance
-            }
-
-        balance.trade_balance -= signal_cost
-        user.in_work += 1
-
-        investment = SignalInvestment(
-            signal_id=signal.id,
-            user_id=user.id,
-            amount=signal_cost,
-            auto_mode=True,
+        # Списываем только за вставленную инвестицию: если пользователь уже в сигнале, повторно не платит
+        inserted = await db.execute(
+            _INSERT_AUTO_MODE_INVESTMENT, {"signal_id": signal.id, "user_id": user.id, "amount": signal_cost}
         )
-        db.add(investment)
+        if inserted.first() is not None:
+            debited = await mutate_balance(db, user.id, {"trade_balance": -signal_cost}, commit=False)
+            if debited is None:
+                await db.rollback()
+                balance = await get_balance(db, user.id)
+                if not balance:
+                    raise HTTPException(status_code=404, detail="Balance not found")
+                return {
+                    "message": "Insufficient trading balance for signal cost",
+                    "success": False,
+                    "required_amount": signal_cost,
+                    "current_balance": balance.trade_balance
+                }
+
+            user.in_work += 1
 
         user.automod = True
         user.auto_mode_locked_until = datetime.utcnow() + timedelta(minutes=MIN_LOCK_PERIOD_MINUTES)
@@ -368,6 +391,7 @@ async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
         db.add(user)
 
         await db.commit()
+        invalidate_user(telegram_id)
 
         next_exit_time = user.auto_mode_locked_until.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -384,7 +408,7 @@ async def enable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
     
 #-------------------------------------------------------------------------# 
 @signalis_router.post("/disable_automode")
-async def disable_automode(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def disable_automode(telegram_id: int, db: AsyncSession = Depends(get_session)):
     try:
         user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
         user = user_result.scalars().first()
@@ -416,6 +440,7 @@ async def disable_automode(telegram_id: int, db: AsyncSession = Depends(get_db))
             pass
 
         await db.commit()
+        invalidate_user(telegram_id)
 
         return {"message": "Auto mode successfully disabled", "success": True}
 
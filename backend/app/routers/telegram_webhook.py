@@ -0,0 +1,23 @@
+import hmac
+import logging
+from fastapi import APIRouter, Header, HTTPException, Request
+from app import telegram_bot
+
+router = APIRouter(prefix="/api/telegram")
+
+#-------------------------------------------------------------------------#   
+
+@router.post("/webhook")
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    """Приём обновлений Telegram в режиме BOT_MODE=webhook: обновление ставится в очередь бота, ответ — сразу"""
+    # Секрет обязателен в режиме webhook; без него (другие режимы) маршрут не принимает ничего
+    secret = telegram_bot.BOT_WEBHOOK_SECRET or ""
+    provided = x_telegram_bot_api_secret_token or ""
+    if not hmac.compare_digest(provided.encode(), secret.encode()) or not secret:
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+
+    if not await telegram_bot.feed_update(await request.json()):
+        logging.warning("Обновление Telegram получено, но бот в этом процессе не запущен")
+        raise HTTPException(status_code=503, detail="Bot is not running")
+
+    return {"ok": True}
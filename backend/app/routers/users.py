@@ -1,13 +1,20 @@
-from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from datetime import datetime
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
-from app.services.get_db import get_db  # Импортируем get_db
+from app.database import get_session  # Сессия на запрос
 from app.database import get_db as main 
 from app.models.models import Profit, Transaction, User, Referrals, Balance  # Убедитесь, что Balance подключена
 from sqlalchemy.orm import subqueryload
 from app.services.users import add_referral
+from app.services.user_cache import get_user_ref, invalidate_user
+from app.services.history import NEXT_CURSOR_HEADER, fetch_history_page, stream_history
+from app.services.read_models import get_user_view, referrer_dict
+from app.services.user_export import EXPORT_FORMATS, build_users_query, parse_columns, stream_users
+from app.services.referrals import REFERRAL_TREE_MAX_DEPTH, link_referral, load_referral_tree, referral_level_counts
 # Логирование
 import logging
 
@@ -38,40 +45,55 @@ router = APIRouter(prefix="/api")
 #-------------------------------------------------------------------------#   
 
 @router.get("/users")
-async def get_users(db: AsyncSession = Depends(get_db)):  # db - это сессия
+async def get_users(
+    format: str = None,
+    plan: int = None,
+    automod: bool = None,
+    created_from: datetime = None,
+    created_to: datetime = None,
+    columns: str = None,
+    db: AsyncSession = Depends(get_session),  # db - это сессия
+):
+    """
+    Список пользователей с балансом и пригласившим (одним запросом, без загрузки ORM-объектов).
+
+    format=ndjson|csv — потоковая выгрузка выбранных колонок (columns=id,telegram_id,balance,...).
+    Фильтры: plan, automod, created_from/created_to (created_at в полуинтервале).
+    """
     try:
-        # Выполняем запрос через сессию db
-        result = await db.execute(
-            select(User)
-            .options(
-                subqueryload(User.balance),  # Используем subqueryload для баланса
-                subqueryload(User.referred_by)  # Используем subqueryload для реферера
+        filters = {"plan": plan, "automod": automod, "created_from": created_from, "created_to": created_to}
+
+        if format is not None:
+            if format not in EXPORT_FORMATS:
+                raise HTTPException(status_code=400, detail="Unsupported format, use ndjson or csv")
+            names = parse_columns(columns)
+            headers = {"Content-Disposition": "attachment; filename=users.csv"} if format == "csv" else None
+            return StreamingResponse(
+                stream_users(build_users_query(names, **filters), names, format),
+                media_type=EXPORT_FORMATS[format],
+                headers=headers,
             )
-        )
-        users = result.scalars().all()  # Получаем список пользователей
-
-        return [
-            {
-                "id": u.id,
-                "telegram_id": u.telegram_id,
-                "username": u.username,
-                "first_name": u.first_name,
-                "last_name": u.last_name,
-                "language_code": u.language_code,
-                "is_bot": u.is_bot,
-                "photo_url": u.photo_url,
-                "created_at": u.created_at,
-                "updated_at": u.updated_at,
-                "balance": u.balance.balance if u.balance else 0.0,
-                "trade_balance": u.balance.trade_balance if u.balance else 0.0,
-                "referred_by": {
-                    "id": u.referred_by.id if u.referred_by else None,
-                    "telegram_id": u.referred_by.telegram_id if u.referred_by else None,
-                    "username": u.referred_by.username if u.referred_by else None
-                } if u.referred_by else None
-            }
-            for u in users
+
+        names = [
+            "id", "telegram_id", "username", "first_name", "last_name", "language_code", "is_bot", "photo_url",
+            "created_at", "updated_at", "balance", "trade_balance",
+            "referred_by_id", "referred_by_telegram_id", "referred_by_username",
         ]
+        result = await db.execute(build_users_query(names, **filters))
+
+        users = []
+        for row in result.mappings():
+            user = dict(row)
+            referrer = {
+                "id": user.pop("referred_by_id"),
+                "telegram_id": user.pop("referred_by_telegram_id"),
+                "username": user.pop("referred_by_username"),
+            }
+            user["referred_by"] = referrer if referrer["id"] is not None else None
+            users.append(user)
+        return users
+    except HTTPException:
+        raise
     except Exception as e:
         # Логирование ошибки
         logging.error(f"Ошибка при получении пользователей: {e}", exc_info=True)
@@ -81,20 +103,12 @@ async def get_users(db: AsyncSession = Depends(get_db)):  # db - это сесс
 
 ### 🔹 **Поиск пользователя по telegram_id**
 @router.get("/user/{telegram_id}")
-async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_db)):
+async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(get_session)):
     try:
         logging.info(f"Пытаемся получить пользователя с telegram_id: {telegram_id}")
 
-        # Запрос с загрузкой баланса и реферера
-        result = await db.execute(
-            select(User)
-            .options(
-                subqueryload(User.balance),  # Баланс
-                subqueryload(User.referred_by)  # Реферер
-            )
-            .filter(User.telegram_id == telegram_id)
-        )
-        user = result.scalars().first()
+        # Пользователь, баланс и реферер — одним запросом по колонкам
+        user = await get_user_view(db, telegram_id)
 
         if user is None:
             logging.warning(f"Пользователь с telegram_id {telegram_id} не найден.")
@@ -116,20 +130,17 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
             "in_work": user.in_work,  # В работе
             "created_at": user.created_at,
             "updated_at": user.updated_at,
-            "plan": user.plan,
             "balance": {
-                "balance": user.balance.balance if user.balance else 0.0,
-                "trade_balance": user.balance.trade_balance if user.balance else 0.0,
-                "frozen_balance": user.balance.frozen_balance if user.balance else 0.0,
-                "earned_balance": user.balance.earned_balance if user.balance else 0.0
-            } if user.balance else None,
-            "referred_by": {
-                "id": user.referred_by.id if user.referred_by else None,
-                "telegram_id": user.referred_by.telegram_id if user.referred_by else None,
-                "username": user.referred_by.username if user.referred_by else None
-            } if user.referred_by else None
+                "balance": user.balance or 0.0,
+                "trade_balance": user.trade_balance or 0.0,
+                "frozen_balance": user.frozen_balance or 0.0,
+                "earned_balance": user.earned_balance or 0.0
+            } if user.balance_id is not None else None,
+            "referred_by": referrer_dict(user)
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Ошибка при получении пользователя с telegram_id {telegram_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An error occurred while retrieving the user.")
@@ -137,25 +148,37 @@ async def get_user_by_telegram_id(telegram_id: int, db: AsyncSession = Depends(g
 #-------------------------------------------------------------------------#   
 
 @router.get("/transactions/{telegram_id}")
-async def get_transactions(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    """ Получает список транзакций пользователя по telegram_id. """
+async def get_transactions(
+    telegram_id: int,
+    response: Response,
+    cursor: str = None,
+    limit: int = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_session),
+):
+    """
+    Получает список транзакций пользователя по telegram_id.
+
+    Без параметров — вся история; с cursor или limit — постранично по (created_at, id),
+    курсор следующей страницы — в заголовке X-Next-Cursor.
+    При stream=true вся история отдаётся потоком NDJSON.
+    """
     try:
-        user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-        user = user_result.scalars().first()
+        user = await get_user_ref(db, telegram_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        transactions_result = await db.execute(
-            select(Transaction).filter(Transaction.user_id == user.id)
-        )
-        transactions = transactions_result.scalars().all()
-
-        return [{
-            "id": transaction.id,
-            "amount": transaction.amount,
-            "transaction_type": transaction.transaction_type,
-            "created_at": transaction.created_at
-        } for transaction in transactions]
+        columns = [Transaction.id, Transaction.amount, Transaction.transaction_type, Transaction.created_at]
+        if stream:
+            return StreamingResponse(stream_history(Transaction, columns, user.id), media_type="application/x-ndjson")
+
+        transactions, next_cursor = await fetch_history_page(db, Transaction, columns, user.id, cursor, limit)
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+
+        return transactions
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error retrieving transactions for telegram_id {telegram_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving transactions.")
@@ -163,25 +186,37 @@ async def get_transactions(telegram_id: int, db: AsyncSession = Depends(get_db))
 #-------------------------------------------------------------------------#   
 
 @router.get("/profits/{telegram_id}")
-async def get_profits(telegram_id: int, db: AsyncSession = Depends(get_db)):
-    """ Получает список прибыли пользователя по telegram_id. """
+async def get_profits(
+    telegram_id: int,
+    response: Response,
+    cursor: str = None,
+    limit: int = None,
+    stream: bool = False,
+    db: AsyncSession = Depends(get_session),
+):
+    """
+    Получает список прибыли пользователя по telegram_id.
+
+    Без параметров — вся история; с cursor или limit — постранично по (created_at, id),
+    курсор следующей страницы — в заголовке X-Next-Cursor.
+    При stream=true вся история отдаётся потоком NDJSON.
+    """
     try:
-        user_result = await db.execute(select(User).filter(User.telegram_id == telegram_id))
-        user = user_result.scalars().first()
+        user = await get_user_ref(db, telegram_id)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
-        profits_result = await db.execute(
-            select(Profit).filter(Profit.user_id == user.id)
-        )
-        profits = profits_result.scalars().all()
-
-        return [{
-            "id": profit.id,
-            "amount": profit.amount,
-            "signal_id": profit.signal_id,
-            "created_at": profit.created_at
-        } for profit in profits]
+        columns = [Profit.id, Profit.amount, Profit.signal_id, Profit.created_at]
+        if stream:
+            return StreamingResponse(stream_history(Profit, columns, user.id), media_type="application/x-ndjson")
+
+        profits, next_cursor = await fetch_history_page(db, Profit, columns, user.id, cursor, limit)
+        if next_cursor:
+            response.headers[NEXT_CURSOR_HEADER] = next_cursor
+
+        return profits
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error retrieving profits for telegram_id {telegram_id}: {str(e)}")
         raise HTTPException(status_code=500, detail="An error occurred while retrieving profits.")
@@ -193,7 +228,7 @@ class ReferralRequest(BaseModel):
     referral_link: str
 
 @router.post("/check_referral")
-async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(get_db)):
+async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(get_session)):
     """ 
     Привязывает пользователя к владельцу реферальной ссылки,
     записывая его telegram_id в поле referred_by.
@@ -226,7 +261,10 @@ async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(ge
             }
         # Записываем telegram_id владельца ссылки в referred_by
         referral.referred_by = referrer.telegram_id
-        referrer.invited_count += 1  # Увеличиваем счётчик приглашённых
+        # Дерево рефералов и счётчик приглашённых обновляются через referral_closure
+        if not await link_referral(db, referral.telegram_id, referrer.telegram_id):
+            await db.rollback()
+            return {"exists": True, "message": "Нельзя привязать пользователя к собственному приглашённому"}
 
         # Сохраняем изменения в БД
         await db.commit()
@@ -245,7 +283,7 @@ async def check_referral(request: ReferralRequest, db: AsyncSession = Depends(ge
 #-------------------------------------------------------------------------#   
 
 @router.put("/user/{telegram_id}/update_plan")
-async def update_user_plan(telegram_id: int, new_plan: int, db: AsyncSession = Depends(get_db)):
+async def update_user_plan(telegram_id: int, new_plan: int, db: AsyncSession = Depends(get_session)):
     """
     Обновляет план пользователя (plan) на одно из значений: 0, 1 или 2.
     """
@@ -267,6 +305,7 @@ async def update_user_plan(telegram_id: int, new_plan: int, db: AsyncSession = D
         user.plan = new_plan
         await db.commit()
         await db.refresh(user)
+        invalidate_user(telegram_id)
 
         logging.info(f"Обновлен план пользователя {telegram_id} до {new_plan}")
         return {"message": "User plan updated successfully", "telegram_id": telegram_id, "new_plan": new_plan}
@@ -281,66 +320,48 @@ async def update_user_plan(telegram_id: int, new_plan: int, db: AsyncSession = D
 #-------------------------------------------------------------------------#  
 
 @router.get("/referral_tree/{telegram_id}")
-async def get_referral_tree(telegram_id: str, db: AsyncSession = Depends(get_db)):
-    async def fetch_referrals(telegram_id):
-        """Рекурсивно получаем всех приглашённых пользователей по их Telegram ID"""
-        logging.info(f"Fetching referrals for telegram_id: {telegram_id}")  
-
-        result = await db.execute(
-            select(Referrals).filter(Referrals.referred_by == telegram_id)  # Ищем рефералов по telegram_id
-        )
-        referrals = result.scalars().all()
-
-        logging.info(f"Found {len(referrals)} referrals for telegram_id: {telegram_id}")  
-
-        return [
-            {
-                "id": r.id,
-                "user_id": r.user_id,
-                "telegram_id": r.telegram_id,
-                "referral_link": r.referral_link,
-                "invited_count": r.invited_count,
-                "referrer_id": r.referrer_id,
-                "referred_by": r.referred_by,
-                "invited_users": await fetch_referrals(r.telegram_id)  # Рекурсивно получаем рефералов
-            }
-            for r in referrals
-        ]
+async def get_referral_tree(
+    telegram_id: str,
+    max_depth: int = REFERRAL_TREE_MAX_DEPTH,
+    level_limit: int = None,
+    level_offset: int = 0,
+    summary: bool = False,
+    db: AsyncSession = Depends(get_session),
+):
+    """
+    Дерево приглашённых пользователей одним запросом к referral_closure.
 
+    max_depth ограничивает глубину, level_limit/level_offset — страницу узлов на каждом уровне.
+    При summary=true возвращается только количество приглашённых по уровням.
+    """
     try:
         logging.info(f"Received request to fetch referral tree for telegram_id: {telegram_id}")  
 
         # Приводим telegram_id к int
         telegram_id = int(telegram_id)
 
-        # Ищем пользователя по его telegram_id
-        result = await db.execute(
-            select(Referrals).filter(Referrals.telegram_id == telegram_id)
-        )
-        user = result.scalars().first()
+        if summary:
+            levels = await referral_level_counts(db, telegram_id, max_depth)
+            if levels is None:
+                logging.warning(f"User not found for telegram_id: {telegram_id}")  
+                raise HTTPException(status_code=404, detail="User not found")
+            return {
+                "telegram_id": telegram_id,
+                "levels": levels,
+                "total": sum(level["count"] for level in levels),
+            }
 
-        if not user:
+        referral_tree = await load_referral_tree(db, telegram_id, max_depth, level_limit, level_offset)
+        if referral_tree is None:
             logging.warning(f"User not found for telegram_id: {telegram_id}")  
             raise HTTPException(status_code=404, detail="User not found")
 
-        logging.info(f"Found user: {user.user_id} with telegram_id: {telegram_id}")  
-
-        # Получаем всех приглашённых пользователей (рефералов)
-        referral_tree = {
-            "id": user.id,
-            "user_id": user.user_id,
-            "telegram_id": user.telegram_id,
-            "referral_link": user.referral_link,
-            "invited_count": user.invited_count,
-            "referrer_id": user.referrer_id,
-            "referred_by": user.referred_by,
-            "invited_users": await fetch_referrals(user.telegram_id)  # Исправленный вызов
-        }
-
         logging.info(f"Referral tree successfully retrieved for telegram_id: {telegram_id}")  
 
         return referral_tree
 
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Error retrieving referral tree for telegram_id: {telegram_id}: {e}", exc_info=True)  
-        raise HTTPException(status_code=500, detail="An error occurred while retrieving referral tree.")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="An error occurred while retrieving referral tree.")
@@ -0,0 +1,54 @@
+import logging
+from sqlalchemy import text
+from app.database import engine
+
+_TRY_LOCK = text("SELECT pg_try_advisory_lock(CAST(:key AS BIGINT))")
+_UNLOCK = text("SELECT pg_advisory_unlock(CAST(:key AS BIGINT))")
+
+
+class AdvisoryLock:
+    """
+    Сессионная advisory-блокировка PostgreSQL: «только один процесс на все воркеры и реплики».
+
+    Блокировка держится на отдельном соединении, пока оно открыто; если процесс падает,
+    соединение закрывается и блокировку может взять другой процесс.
+    """
+
+    def __init__(self, key: int):
+        self.key = key
+        self._conn = None
+
+    @property
+    def held(self) -> bool:
+        return self._conn is not None
+
+    async def try_acquire(self) -> bool:
+        if self._conn is not None:
+            return True
+
+        conn = await engine.connect()
+        try:
+            acquired = (await conn.execute(_TRY_LOCK, {"key": self.key})).scalar()
+            await conn.commit()  # Блокировка сессионная — транзакция ей не нужна
+        except Exception:
+            await conn.close()
+            raise
+
+        if not acquired:
+            await conn.close()
+            return False
+
+        self._conn = conn
+        return True
+
+    async def release(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            await conn.execute(_UNLOCK, {"key": self.key})
+            await conn.commit()
+        except Exception as e:
+            logging.error(f"Ошибка при снятии advisory-блокировки {self.key}: {e}")
+        finally:
+            await conn.close()
@@ -1,72 +1,136 @@
 from datetime import datetime, timezone, timedelta
 import random
+from sqlalchemy import func, text
 from sqlalchemy.future import select
-from app.models.models import User, Signal, SignalInvestment, Balance
+from app.models.models import User, Signal
+from app.services.scheduler import signal_scheduler
+from app.services.signal_feed import signal_feed
 
-async def process_auto_mode_users(db):
-    """Обрабатывает пользователей с включенным автомодом, автоматически подключая их к сигналам"""
-    now = datetime.now(timezone.utc)
+# Минимальный баланс для участия в автомоде
+AUTO_MODE_MIN_BALANCE = 10
 
-    # 1️⃣ Получаем всех пользователей, у которых включен автомод
-    result = await db.execute(select(User).filter(User.auto_mode_enabled == True))
-    auto_users = result.scalars().all()
+# Один проход зачисления: кандидаты (пользователи с автомодом без инвестиции в сигнал) с достаточным
+# балансом (строки баланса блокируются) → массовая вставка инвестиций → списание и in_work только за вставленные.
+# ON CONFLICT пропускает пары, которые успел создать параллельный вход, — за них не списывается.
+_ENROLL_AUTO_MODE_USERS = text("""
+    WITH candidates AS (
+        SELECT u.id AS user_id
+        FROM users AS u
+        WHERE u.auto_mode_enabled = TRUE
+          AND NOT EXISTS (
+              SELECT 1 FROM signal_investments AS si
+              WHERE si.signal_id = CAST(:signal_id AS INTEGER) AND si.user_id = u.id
+          )
+    ),
+    funded AS (
+        SELECT b.user_id
+        FROM balances AS b
+        JOIN candidates AS c ON c.user_id = b.user_id
+        WHERE b.balance >= GREATEST(CAST(:signal_cost AS DOUBLE PRECISION), CAST(:min_balance AS DOUBLE PRECISION))
+        FOR UPDATE OF b
+    ),
+    enrolled AS (
+        INSERT INTO signal_investments (signal_id, user_id, amount, auto_mode, is_checked)
+        SELECT DISTINCT CAST(:signal_id AS INTEGER), f.user_id, CAST(:signal_cost AS DOUBLE PRECISION), TRUE, FALSE
+        FROM funded AS f
+        ON CONFLICT (signal_id, user_id) DO NOTHING
+        RETURNING user_id
+    ),
+    debited AS (
+        UPDATE balances AS b
+        SET balance = b.balance - CAST(:signal_cost AS DOUBLE PRECISION)
+        FROM enrolled AS e
+        WHERE b.user_id = e.user_id
+        RETURNING b.user_id
+    ),
+    work AS (
+        -- Как при ручном входе: обработка сигнала уменьшает in_work за каждую закрытую инвестицию
+        UPDATE users AS u
+        SET in_work = u.in_work + 1
+        FROM enrolled AS e
+        WHERE u.id = e.user_id
+        RETURNING u.id
+    )
+    SELECT
+        (SELECT count(*) FROM candidates) AS candidates,
+        (SELECT count(DISTINCT user_id) FROM funded) AS funded,
+        (SELECT count(*) FROM enrolled) AS enrolled
+""")
 
-    for user in auto_users:
-        # 2️⃣ Получаем баланс пользователя
-        balance_result = await db.execute(select(Balance).filter(Balance.user_id == user.id))
-        balance = balance_result.scalars().first()
 
-        if not balance or balance.balance < 10:  # Проверка минимального баланса
-            print(f"⛔ Пользователь {user.id} не может участвовать - недостаточно средств!")
-            continue
+async def get_or_create_auto_signal(db, now: datetime) -> Signal:
+    """Находит сигнал, в который ещё можно войти (окно входа открыто, сигнал не обработан), или создаёт авто-сигнал"""
+    signal_result = await db.execute(
+        select(Signal)
+        .filter(Signal.join_until > now, Signal.expires_at > now, Signal.is_successful.is_(None))
+        .order_by(Signal.id)
+        .limit(1)
+    )
+    signal = signal_result.scalars().first()
 
-        # 3️⃣ Ищем активный сигнал
-        signal_result = await db.execute(select(Signal).filter(Signal.expires_at > now))
-        signal = signal_result.scalars().first()
+    if signal:
+        return signal
 
-        # 4️⃣ Если активного сигнала нет — создаём новый
-        if not signal:
-            # Создаем авто-сигнал с случайными параметрами или заданными для автоматического режима
-            burn_chance = random.uniform(1, 5)  # случайный шанс сгорания от 1 до 5%
-            profit_percent = random.uniform(5, 15)  # случайный процент прибыли от 5 до 15%
-            signal_cost = random.randint(100, 200)  # случайная стоимость входа
+    # Создаем авто-сигнал с случайными параметрами или заданными для автоматического режима
+    burn_chance = random.uniform(1, 5)  # случайный шанс сгорания от 1 до 5%
+    profit_percent = random.uniform(5, 15)  # случайный процент прибыли от 5 до 15%
+    signal_cost = random.randint(100, 200)  # случайная стоимость входа
 
-            signal = Signal(
-                name="Автоматический сигнал",
-                join_until=now + timedelta(minutes=5),  # Время на вход в сигнал
-                expires_at=now + timedelta(hours=1),  # Сигнал активен 1 час
-                is_successful=None,
-                burn_chance=burn_chance,  # случайный шанс сгорания
-                profit_percent=profit_percent,  # случайный процент прибыли
-                signal_cost=signal_cost  # случайная цена входа
-            )
-            db.add(signal)
-            await db.commit()  # Асинхронно коммитим
+    signal = Signal(
+        name="Автоматический сигнал",
+        join_until=now + timedelta(minutes=5),  # Время на вход в сигнал
+        expires_at=now + timedelta(hours=1),  # Сигнал активен 1 час
+        is_successful=None,
+        burn_chance=burn_chance,  # случайный шанс сгорания
+        profit_percent=profit_percent,  # случайный процент прибыли
+        signal_cost=signal_cost  # случайная цена входа
+    )
+    db.add(signal)
+    await db.commit()  # Асинхронно коммитим
+    signal_scheduler.notify_signal(signal)
+    signal_feed.invalidate()
 
-            print(f"🚀 Новый авто-сигнал создан с параметрами: {signal.name}, шанс сгорания: {burn_chance}%, процент прибыли: {profit_percent}%, цена: {signal_cost}")
+    print(f"🚀 Новый авто-сигнал создан с параметрами: {signal.name}, шанс сгорания: {burn_chance}%, процент прибыли: {profit_percent}%, цена: {signal_cost}")
+    return signal
 
-        # 5️⃣ Проверяем, что пользователь уже не участвует в сигнале
-        investment_result = await db.execute(
-            select(SignalInvestment).filter(
-                SignalInvestment.user_id == user.id,
-                SignalInvestment.signal_id == signal.id
-            )
-        )
-        existing_investment = investment_result.scalars().first()
 
-        if existing_investment:
-            print(f"✅ Пользователь {user.id} уже участвует в сигнале {signal.id}")
-            continue
+async def process_auto_mode_users(db) -> dict:
+    """
+    Подключает всех пользователей с включенным автомодом к активному сигналу одним массовым проходом.
+
+    :return: Счётчики цикла: enrolled (подключены), skipped (уже участвуют), insufficient_funds (недостаточно средств).
+    """
+    now = datetime.now(timezone.utc)
+
+    # 1️⃣ Сколько пользователей с автомодом (без них сигнал не создаём)
+    total = (await db.execute(select(func.count(User.id)).filter(User.auto_mode_enabled == True))).scalar()
+    if not total:
+        return {"signal_id": None, "enrolled": 0, "skipped": 0, "insufficient_funds": 0}
+
+    # 2️⃣ Целевой сигнал определяется один раз на весь цикл
+    signal = await get_or_create_auto_signal(db, now)
 
-        # 6️⃣ Создаём инвестицию
-        investment = SignalInvestment(
-            user_id=user.id,
-            signal_id=signal.id,
-            amount=signal.signal_cost,
-            auto_mode=True
+    # 3️⃣ Кандидаты, списания и инвестиции — одним запросом в одной транзакции
+    try:
+        result = await db.execute(
+            _ENROLL_AUTO_MODE_USERS,
+            {"signal_id": signal.id, "signal_cost": signal.signal_cost, "min_balance": AUTO_MODE_MIN_BALANCE},
         )
-        balance.balance -= signal.signal_cost  # Списываем деньги с баланса
+        candidates, funded, enrolled = result.one()
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
 
-        db.add(investment)
-        await db.commit()  # Асинхронно коммитим
-        print(f"🚀 Пользователь {user.id} подключен к сигналу {signal.id} с автоматическим режимом")
+    stats = {
+        "signal_id": signal.id,
+        "enrolled": enrolled,
+        # Пары, которые успел создать параллельный вход (ON CONFLICT), тоже «уже участвуют»
+        "skipped": total - candidates + (funded - enrolled),
+        "insufficient_funds": candidates - funded,
+    }
+    print(
+        f"🚀 Автомод, сигнал {signal.id}: подключено {stats['enrolled']}, "
+        f"уже участвуют {stats['skipped']}, недостаточно средств {stats['insufficient_funds']}"
+    )
+    return stats
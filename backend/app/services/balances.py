@@ -1,10 +1,12 @@
 import logging
 from sqlalchemy.ext.asyncio import AsyncSession
+from typing import NamedTuple
+from sqlalchemy import case, insert, literal, union_all, update
 from sqlalchemy.future import select
 from sqlalchemy.exc import SQLAlchemyError
-from app.models.models import Balance, Referrals
-from app.statistics_services.balance_actions import log_transaction
+from app.models.models import Balance, Referrals, Transaction
 from app.database import get_db
+from app.services.referrals import link_referral
 
 # Отключаем SQLAlchemy INFO-логи
 logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
@@ -54,75 +56,209 @@ async def create_or_update_balance(db: AsyncSession, user_id: int, balance: floa
         await db.rollback()
         return None
 
-async def update_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
-    try:
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
+# Колонки баланса, которые можно менять через mutate_balance
+BALANCE_COLUMNS = ("balance", "trade_balance", "frozen_balance", "earned_balance")
 
-        if balance:
-            balance.balance += amount
-            await db.commit()
-            await db.refresh(balance)
-            await log_transaction(db, user_id, amount, "balance_update")
-            return True
-        return False
-    except SQLAlchemyError as e:
-        logging.error(f"Ошибка обновления баланса {user_id}: {e}")
-        await db.rollback()
-        return False
 
-async def update_trading_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
-    try:
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
+async def mutate_balance(
+    db: AsyncSession,
+    user_id: int,
+    deltas: dict,
+    transaction_type: str = None,
+    ledger_amount: float = None,
+    commit: bool = True,
+):
+    """
+    Атомарно изменяет баланс пользователя одним запросом UPDATE ... RETURNING.
 
-        if balance:
-            balance.trade_balance += amount
-            await db.commit()
-            await db.refresh(balance)
-            await log_transaction(db, user_id, amount, "trade_balance_update")
-            return True
-        return False
-    except SQLAlchemyError as e:
-        logging.error(f"Ошибка обновления торгового баланса {user_id}: {e}")
-        await db.rollback()
-        return False
+    Для каждой колонки с отрицательной дельтой в WHERE добавляется проверка достаточности средств,
+    поэтому параллельные списания не могут увести баланс в минус или потерять обновление.
+    Если указан transaction_type, запись в журнал транзакций добавляется в том же запросе (CTE).
 
-async def freeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
-    try:
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
+    :param db: Асинхронная сессия SQLAlchemy.
+    :param user_id: ID пользователя (users.id).
+    :param deltas: Изменения по колонкам, например {"balance": -10.0, "frozen_balance": 10.0}.
+    :param transaction_type: Тип записи в журнале транзакций (None — без записи).
+    :param ledger_amount: Сумма для журнала (по умолчанию — сумма первой дельты).
+    :param commit: Коммитить ли транзакцию (False — изменение остаётся в транзакции вызывающего кода).
 
-        if balance and balance.balance >= amount:
-            balance.balance -= amount
-            balance.frozen_balance += amount
-            await db.commit()
-            await db.refresh(balance)
-            await log_transaction(db, user_id, amount, "freeze")
-            return True
-        return False
+    :return: Строка с новым состоянием баланса или None, если баланса нет или средств недостаточно.
+    """
+    unknown = set(deltas) - set(BALANCE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Неизвестные колонки баланса: {', '.join(sorted(unknown))}")
+
+    conditions = [Balance.user_id == user_id]
+    values = {}
+    for column_name, delta in deltas.items():
+        column = getattr(Balance, column_name)
+        values[column_name] = column + delta
+        if delta < 0:
+            conditions.append(column >= -delta)  # Защита от ухода в минус
+
+    moved = (
+        update(Balance)
+        .where(*conditions)
+        .values(**values)
+        .returning(
+            Balance.user_id,
+            Balance.balance,
+            Balance.trade_balance,
+            Balance.frozen_balance,
+            Balance.earned_balance,
+        )
+        .cte("moved")
+    )
+    stmt = select(moved)
+
+    if transaction_type:
+        if ledger_amount is None:
+            ledger_amount = next(iter(deltas.values()))
+        ledger = (
+            insert(Transaction)
+            .from_select(
+                ["user_id", "amount", "transaction_type"],
+                select(moved.c.user_id, literal(ledger_amount), literal(transaction_type)),
+            )
+            .cte("ledger")
+        )
+        stmt = stmt.add_cte(ledger)
+
+    try:
+        result = await db.execute(stmt)
+        row = result.first()
+        if commit:
+            if row is None:
+                await db.rollback()
+            else:
+                await db.commit()
+        return row
     except SQLAlchemyError as e:
-        logging.error(f"Ошибка при заморозке баланса {user_id}: {e}")
+        logging.error(f"Ошибка изменения баланса {user_id}: {e}")
         await db.rollback()
-        return False
+        return None
+
+async def update_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
+    row = await mutate_balance(db, user_id, {"balance": amount}, "balance_update")
+    return row is not None
+
+async def update_trading_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
+    row = await mutate_balance(db, user_id, {"trade_balance": amount}, "trade_balance_update")
+    return row is not None
+
+async def freeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
+    row = await mutate_balance(db, user_id, {"balance": -amount, "frozen_balance": amount}, "freeze", amount)
+    return row is not None
 
 async def unfreeze_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
-    try:
-        result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-        balance = result.scalars().first()
+    row = await mutate_balance(db, user_id, {"frozen_balance": -amount, "balance": amount}, "unfreeze", amount)
+    return row is not None
 
-        if balance and balance.frozen_balance >= amount:
-            balance.frozen_balance -= amount
-            balance.balance += amount
-            await db.commit()
-            await db.refresh(balance)
-            await log_transaction(db, user_id, amount, "unfreeze")
-            return True
-        return False
+class BalanceLeg(NamedTuple):
+    """Одна нога перевода: сумма переносится из колонки source в колонку target."""
+    source: str
+    target: str
+    amount: float
+    transaction_type: str = None  # Тип записи в журнале (None — без записи)
+    optional: bool = False  # Применяется, только если после обязательных ног в source хватает средств
+
+
+async def transfer_balance(db: AsyncSession, user_id: int, legs: list, commit: bool = True):
+    """
+    Атомарно применяет многоногий перевод между balance, trade_balance и frozen_balance одним запросом.
+
+    Строка баланса блокируется (SELECT ... FOR UPDATE) в том же запросе, обязательные ноги
+    проверяются на достаточность средств, необязательные применяются только при достаточном остатке.
+    Записи в журнал транзакций вставляются в том же запросе для каждой применённой ноги.
+
+    :param db: Асинхронная сессия SQLAlchemy.
+    :param user_id: ID пользователя (users.id).
+    :param legs: Список BalanceLeg.
+    :param commit: Коммитить ли транзакцию.
+
+    :return: Итоговый снимок баланса (balance, trade_balance, frozen_balance, earned_balance
+             и флаги leg_N применённых ног) или None, если средств недостаточно или баланса нет.
+    """
+    for leg in legs:
+        if leg.source not in BALANCE_COLUMNS or leg.target not in BALANCE_COLUMNS:
+            raise ValueError(f"Неизвестная колонка баланса в переводе: {leg.source} -> {leg.target}")
+        if leg.amount <= 0:
+            raise ValueError("Сумма перевода должна быть больше нуля")
+
+    cur = (
+        select(Balance.id, *(getattr(Balance, column) for column in BALANCE_COLUMNS))
+        .where(Balance.user_id == user_id)
+        .limit(1)
+        .with_for_update()
+        .cte("cur")
+    )
+
+    # Обязательные ноги — фиксированные дельты, по ним проверяется достаточность средств
+    required = dict.fromkeys(BALANCE_COLUMNS, 0.0)
+    for leg in legs:
+        if not leg.optional:
+            required[leg.source] -= leg.amount
+            required[leg.target] += leg.amount
+
+    deltas = {column: literal(delta) for column, delta in required.items()}
+    applied = []
+    for leg in legs:
+        if not leg.optional:
+            applied.append(literal(True))
+            continue
+        is_applied = cur.c[leg.source] + required[leg.source] >= leg.amount
+        moved_amount = case((is_applied, leg.amount), else_=0.0)
+        deltas[leg.source] = deltas[leg.source] - moved_amount
+        deltas[leg.target] = deltas[leg.target] + moved_amount
+        applied.append(is_applied)
+
+    guards = [cur.c[column] >= -delta for column, delta in required.items() if delta < 0]
+
+    moved = (
+        update(Balance)
+        .where(Balance.id == cur.c.id, *guards)
+        .values({column: cur.c[column] + delta for column, delta in deltas.items()})
+        .returning(
+            Balance.user_id,
+            Balance.balance,
+            Balance.trade_balance,
+            Balance.frozen_balance,
+            Balance.earned_balance,
+            *(flag.label(f"leg_{i}") for i, flag in enumerate(applied)),
+        )
+        .cte("moved")
+    )
+    stmt = select(moved)
+
+    ledger_selects = [
+        select(moved.c.user_id, literal(leg.amount), literal(leg.transaction_type)).where(moved.c[f"leg_{i}"])
+        for i, leg in enumerate(legs)
+        if leg.transaction_type
+    ]
+    if ledger_selects:
+        ledger = (
+            insert(Transaction)
+            .from_select(
+                ["user_id", "amount", "transaction_type"],
+                ledger_selects[0] if len(ledger_selects) == 1 else union_all(*ledger_selects),
+            )
+            .cte("ledger")
+        )
+        stmt = stmt.add_cte(ledger)
+
+    try:
+        result = await db.execute(stmt)
+        row = result.first()
+        if commit:
+            if row is None:
+                await db.rollback()
+            else:
+                await db.commit()
+        return row
     except SQLAlchemyError as e:
-        logging.error(f"Ошибка при разморозке баланса {user_id}: {e}")
+        logging.error(f"Ошибка перевода между балансами {user_id}: {e}")
         await db.rollback()
-        return False
+        return None
 
 async def has_sufficient_balance(db: AsyncSession, user_id: int, amount: float) -> bool:
     try:
@@ -165,8 +301,11 @@ async def update_referral_by_url(referral_by_telegram: Referrals, referral_by_li
             referral_owner = await db.merge(referral_owner)
             referral_by_telegram = await db.merge(referral_by_telegram)
 
-            referral_owner.invited_count += 1
             referral_by_telegram.referred_by = link_telegram_id
+            # Перепривязка поддерева и счетчики приглашенных — через referral_closure
+            if not await link_referral(db, referral_by_telegram.telegram_id, link_telegram_id):
+                await db.rollback()
+                return False
 
             await db.commit()
             await db.refresh(referral_by_telegram)
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+from sqlalchemy import Text, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.database import engine
+from app.roles import APP_ROLE
+
+# Шина инвалидации кэшей между процессами (PostgreSQL LISTEN/NOTIFY).
+# По умолчанию включена, когда роли разнесены по процессам (APP_ROLE не all).
+CACHE_BUS = os.getenv("CACHE_BUS", "false" if APP_ROLE == "all" else "true").lower() in ("1", "true", "yes")
+CACHE_BUS_CHANNEL = os.getenv("CACHE_BUS_CHANNEL", "cache_invalidation")
+CACHE_BUS_RECONNECT = float(os.getenv("CACHE_BUS_RECONNECT", 5))  # секунды до повторного подключения слушателя
+
+# Все сообщения, накопившиеся с прошлой отправки, уходят одним запросом
+_NOTIFY = text(
+    "SELECT pg_notify(CAST(:channel AS TEXT), payload) FROM unnest(CAST(:payloads AS TEXT[])) AS payload"
+).bindparams(bindparam("payloads", type_=ARRAY(Text)))
+
+
+class CacheBus:
+    """
+    Рассылка инвалидаций кэшей другим процессам (API, бот, планировщик).
+
+    publish() синхронный и ничего не ждёт: сообщение ставится в очередь и отправляется фоновой задачей
+    через pg_notify. Слушатель держит отдельное соединение с LISTEN и вызывает обработчики по виду
+    сообщения; собственные сообщения процесса пропускаются — локальный кэш уже сброшен.
+    После переподключения слушателя вызываются обработчики сброса: пропущенные сообщения не восстановить.
+    """
+
+    def __init__(self, channel: str = CACHE_BUS_CHANNEL):
+        self.channel = channel
+        self.origin = secrets.token_hex(4)
+        self._handlers = {}
+        self._reset_handlers = []
+        self._outbox = asyncio.Queue()
+        self._tasks = []
+        self.metrics = {"published": 0, "received": 0, "failed_publishes": 0, "reconnects": 0}
+
+    def on(self, kind: str, handler):
+        """Обработчик сообщений вида kind: handler(value)."""
+        self._handlers[kind] = handler
+
+    def on_reset(self, handler):
+        """Обработчик полного сброса (после потери соединения слушателя)."""
+        self._reset_handlers.append(handler)
+
+    def publish(self, kind: str, value=None):
+        if not self._tasks:
+            return
+        self._outbox.put_nowait(json.dumps({"o": self.origin, "k": kind, "v": value}, separators=(",", ":")))
+
+    def _dispatch(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+        if message["o"] == self.origin:
+            return
+        handler = self._handlers.get(message["k"])
+        if handler is None:
+            return
+        self.metrics["received"] += 1
+        try:
+            handler(message["v"])
+        except Exception as e:
+            logging.error(f"Ошибка обработки инвалидации {message['k']}: {e}")
+
+    def _reset(self):
+        for handler in self._reset_handlers:
+            handler()
+
+    async def _publisher(self):
+        while True:
+            payloads = [await self._outbox.get()]
+            while not self._outbox.empty():
+                payloads.append(self._outbox.get_nowait())
+            await self._send(payloads)
+
+    async def _send(self, payloads: list):
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(_NOTIFY, {"channel": self.channel, "payloads": payloads})
+                await conn.commit()
+            self.metrics["published"] += len(payloads)
+        except Exception as e:
+            self.metrics["failed_publishes"] += len(payloads)
+            logging.error(f"Ошибка отправки инвалидаций ({len(payloads)}): {e}")
+
+    async def _listener(self):
+        first = True
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    raw = (await conn.get_raw_connection()).driver_connection  # соединение asyncpg
+                    closed = asyncio.Event()
+                    raw.add_termination_listener(lambda connection: closed.set())
+                    await raw.add_listener(self.channel, self._dispatch)
+                    if not first:
+                        self.metrics["reconnects"] += 1
+                        self._reset()
+                    first = False
+                    try:
+                        await closed.wait()
+                    finally:
+                        if not raw.is_closed():
+                            await raw.remove_listener(self.channel, self._dispatch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Слушатель инвалидаций потерял соединение: {e}")
+            await asyncio.sleep(CACHE_BUS_RECONNECT)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._publisher()), asyncio.create_task(self._listener())]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Отправляем то, что не успел отправить фоновый отправитель
+        payloads = []
+        while not self._outbox.empty():
+            payloads.append(self._outbox.get_nowait())
+        if payloads:
+            await self._send(payloads)
+
+    def get_metrics(self) -> dict:
+        return {**self.metrics, "enabled": CACHE_BUS, "role": APP_ROLE, "outbox": self._outbox.qsize()}
+
+
+cache_bus = CacheBus()
@@ -0,0 +1,97 @@
+import base64
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from fastapi import HTTPException
+from sqlalchemy import tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.database import get_db
+
+# Размер страницы истории по умолчанию и его верхняя граница
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 500))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", 1000))
+# Сколько строк за раз забирать из серверного курсора в потоковом режиме
+HISTORY_STREAM_CHUNK = int(os.getenv("HISTORY_STREAM_CHUNK", 1000))
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """Разбирает курсор страницы; некорректный курсор — ошибка 400."""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def fetch_history_page(db: AsyncSession, model, columns: list, user_id: int, cursor: str = None, limit: int = None):
+    """
+    Страница истории пользователя по ключу (created_at, id): самые новые записи старше курсора.
+
+    Запрос идёт по индексу (user_id, created_at, id) и читает не больше limit + 1 строк.
+    Внутри страницы записи возвращаются в хронологическом порядке.
+    Без cursor и limit возвращается вся история, как до постраничного режима (на это рассчитан фронтенд).
+
+    :return: (строки страницы, курсор следующей страницы или None)
+    """
+    if cursor is None and limit is None:
+        query = select(*columns).filter(model.user_id == user_id).order_by(model.created_at, model.id)
+        return [dict(row) for row in (await db.execute(query)).mappings().all()], None
+
+    limit = max(1, min(limit or HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE))
+
+    query = select(*columns).filter(model.user_id == user_id)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, row_id))
+    query = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last["created_at"], last["id"])
+
+    return [dict(row) for row in reversed(rows)], next_cursor
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def to_ndjson(row: dict) -> str:
+    """Одна строка NDJSON (даты — ISO 8601, Decimal — числом)."""
+    return json.dumps(row, default=_json_default, ensure_ascii=False) + "\n"
+
+
+async def stream_history(model, columns: list, user_id: int):
+    """
+    Вся история пользователя в формате NDJSON в хронологическом порядке.
+
+    Строки читаются серверным курсором порциями по HISTORY_STREAM_CHUNK; у потока своя сессия,
+    потому что сессия запроса закрывается раньше, чем ответ будет отдан целиком.
+    """
+    query = (
+        select(*columns)
+        .filter(model.user_id == user_id)
+        .order_by(model.created_at, model.id)
+        .execution_options(yield_per=HISTORY_STREAM_CHUNK)
+    )
+    async with get_db() as db:
+        result = await db.stream(query)
+        async for row in result.mappings():
+            yield to_ndjson(dict(row))
@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy import Integer, bindparam, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from app.database import AsyncSessionLocal
+
+# Входы в сигналы через очередь допуска (false — каждый запрос выполняет вход сам)
+JOIN_ADMISSION_QUEUE = os.getenv("JOIN_ADMISSION_QUEUE", "true").lower() in ("1", "true", "yes")
+JOIN_QUEUE_SIZE = int(os.getenv("JOIN_QUEUE_SIZE", 10000))
+JOIN_BATCH_SIZE = int(os.getenv("JOIN_BATCH_SIZE", 500))
+JOIN_BATCH_WINDOW = float(os.getenv("JOIN_BATCH_WINDOW", 0.01))  # секунды ожидания добора пакета
+
+# Пакетный вход: строки баланса всех участников пакета блокируются один раз, инвестиции вставляются
+# одним INSERT, списания и in_work — одним UPDATE на пользователя. Входы одного пользователя в несколько
+# сигналов допускаются жадно в порядке signal_id (рекурсивный admitted): неподъёмный вход пропускается,
+# а следующие проверяются по оставшемуся балансу — как при последовательных запросах.
+# Уникальный индекс (signal_id, user_id) отсекает параллельные входы в обход очереди.
+_JOIN_BATCH = text("""
+    WITH RECURSIVE req AS (
+        SELECT signal_id, user_id
+        FROM unnest(CAST(:signal_ids AS INTEGER[]), CAST(:user_ids AS INTEGER[])) AS r(signal_id, user_id)
+    ),
+    sig AS (
+        SELECT s.id, s.signal_cost
+        FROM signals AS s
+        WHERE s.id IN (SELECT signal_id FROM req) AND s.join_until > now() AND s.is_successful IS NULL
+    ),
+    bal AS (
+        SELECT b.user_id, b.trade_balance
+        FROM balances AS b
+        WHERE b.user_id IN (SELECT user_id FROM req)
+        FOR UPDATE
+    ),
+    existing AS (
+        SELECT si.signal_id, si.user_id
+        FROM signal_investments AS si
+        JOIN req ON req.signal_id = si.signal_id AND req.user_id = si.user_id
+    ),
+    eligible AS (
+        SELECT req.signal_id, req.user_id, sig.signal_cost, bal.trade_balance,
+               row_number() OVER (PARTITION BY req.user_id ORDER BY req.signal_id) AS position
+        FROM req
+        JOIN sig ON sig.id = req.signal_id
+        JOIN bal ON bal.user_id = req.user_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM existing AS e WHERE e.signal_id = req.signal_id AND e.user_id = req.user_id
+        )
+    ),
+    admitted AS (
+        SELECT e.user_id, e.position, e.signal_id, e.signal_cost, e.signal_cost <= e.trade_balance AS admit,
+               e.trade_balance - CASE WHEN e.signal_cost <= e.trade_balance THEN e.signal_cost ELSE 0 END AS remaining
+        FROM eligible AS e
+        WHERE e.position = 1
+      UNION ALL
+        SELECT e.user_id, e.position, e.signal_id, e.signal_cost, e.signal_cost <= a.remaining,
+               a.remaining - CASE WHEN e.signal_cost <= a.remaining THEN e.signal_cost ELSE 0 END
+        FROM admitted AS a
+        JOIN eligible AS e ON e.user_id = a.user_id AND e.position = a.position + 1
+    ),
+    inv AS (
+        INSERT INTO signal_investments (signal_id, user_id, amount, auto_mode, is_checked)
+        SELECT signal_id, user_id, signal_cost, FALSE, FALSE
+        FROM admitted
+        WHERE admit
+        ON CONFLICT DO NOTHING
+        RETURNING signal_id, user_id, amount
+    ),
+    debited AS (
+        UPDATE balances AS b
+        SET trade_balance = b.trade_balance - d.total
+        FROM (SELECT user_id, sum(amount) AS total FROM inv GROUP BY user_id) AS d
+        WHERE b.user_id = d.user_id
+        RETURNING b.user_id
+    ),
+    work AS (
+        UPDATE users AS u
+        SET in_work = u.in_work + d.joined
+        FROM (SELECT user_id, count(*) AS joined FROM inv GROUP BY user_id) AS d
+        WHERE u.id = d.user_id
+        RETURNING u.id
+    )
+    SELECT req.signal_id, req.user_id,
+           EXISTS (
+               SELECT 1 FROM existing AS e WHERE e.signal_id = req.signal_id AND e.user_id = req.user_id
+           ) AS already_joined,
+           sig.signal_cost,
+           bal.trade_balance,
+           inv.amount IS NOT NULL AS inserted
+    FROM req
+    LEFT JOIN sig ON sig.id = req.signal_id
+    LEFT JOIN bal ON bal.user_id = req.user_id
+    LEFT JOIN inv ON inv.signal_id = req.signal_id AND inv.user_id = req.user_id
+""").bindparams(
+    bindparam("signal_ids", type_=ARRAY(Integer)),
+    bindparam("user_ids", type_=ARRAY(Integer)),
+)
+
+
+def build_join_response(signal_id: int, already_joined: bool, signal_cost, trade_balance, inserted: bool,
+                        debited: bool = True) -> dict:
+    """
+    Ответ /api/signals/join по результату попытки входа.
+
+    :param inserted: Инвестиция вставлена.
+    :param debited: Условное списание прошло (False — баланс успели уменьшить параллельно, вход откатывается).
+    """
+    if already_joined:
+        return {"message": "User has already joined this signal", "success": False}
+
+    if signal_cost is None:
+        return {
+            "message": "Signal is not available for joining",
+            "success": False,
+            "server_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "signal_join_until": "N/A"
+        }
+
+    if trade_balance is None:
+        return {"message": "Balance not found", "success": False}
+
+    if inserted and debited:
+        return {
+            "message": "Successfully joined the signal",
+            "success": True,
+            "signal_id": signal_id,
+            "amount": signal_cost
+        }
+
+    # Инвестиция не вставилась при достаточном балансе — её только что создал параллельный запрос
+    if not inserted and trade_balance >= signal_cost:
+        return {"message": "User has already joined this signal", "success": False}
+
+    return {
+        "message": "Insufficient trading balance for signal cost",
+        "success": False,
+        "required_amount": signal_cost,
+        "current_balance": trade_balance
+    }
+
+
+class JoinAdmissionQueue:
+    """
+    Очередь допуска входов в сигналы.
+
+    Запросы кладут намерение (user_id, signal_id) в очередь и ждут future; фоновая задача собирает
+    пакет (до JOIN_BATCH_SIZE намерений или JOIN_BATCH_WINDOW секунд), схлопывает повторы и применяет
+    его одним запросом в одной транзакции — одно соединение из пула на пакет, а не на каждый запрос.
+    """
+
+    def __init__(self, queue_size: int = JOIN_QUEUE_SIZE, batch_size: int = JOIN_BATCH_SIZE,
+                 batch_window: float = JOIN_BATCH_WINDOW):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._task = None
+        self._stopping = False
+        self._collecting = []  # намерения, уже взятые из очереди в собираемый пакет
+        self._applying = False
+        self.metrics = {
+            "submitted": 0,
+            "rejected_full": 0,
+            "rejected_stopped": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "joined": 0,
+            "coalesced": 0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0.0,
+            "max_batch_ms": 0.0,
+            "last_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def start(self):
+        if self._task is None and not self._stopping:
+            self._task = asyncio.create_task(self._run())
+
+    async def submit(self, user_id: int, signal_id: int) -> dict:
+        """Ставит вход в очередь и возвращает ответ для /api/signals/join после применения пакета."""
+        if self._stopping:
+            self.metrics["rejected_stopped"] += 1
+            return {"message": "Service is shutting down, try again later", "success": False}
+
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((user_id, signal_id, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.metrics["rejected_full"] += 1
+            return {"message": "Too many join requests, try again later", "success": False}
+
+        self.metrics["submitted"] += 1
+        return await future
+
+    async def _collect(self) -> list:
+        batch = self._collecting = [await self.queue.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        self._collecting = []
+        return batch
+
+    async def apply(self, batch: list):
+        """Применяет пакет намерений и разрешает их future."""
+        started = time.perf_counter()
+
+        # Схлопываем повторы: одна пара (signal_id, user_id) — одна строка в запросе
+        waiters = {}
+        for user_id, signal_id, future, enqueued_at in batch:
+            waiters.setdefault((signal_id, user_id), []).append(future)
+            wait_ms = round((started - enqueued_at) * 1000, 2)
+            self.metrics["last_wait_ms"] = wait_ms
+            self.metrics["max_wait_ms"] = max(self.metrics["max_wait_ms"], wait_ms)
+        self.metrics["coalesced"] += len(batch) - len(waiters)
+
+        pairs = sorted(waiters)  # один порядок блокировок для всех пакетов
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    _JOIN_BATCH,
+                    {"signal_ids": [signal_id for signal_id, _ in pairs], "user_ids": [user_id for _, user_id in pairs]},
+                )
+                rows = result.all()
+                await db.commit()
+        except Exception as e:
+            self.metrics["failed_batches"] += 1
+            logging.error(f"Ошибка при пакетном входе в сигналы ({len(pairs)} входов): {e}")
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_result({"message": "An error occurred while joining the signal", "success": False})
+            return
+
+        joined = 0
+        for row in rows:
+            response = build_join_response(
+                row.signal_id, row.already_joined, row.signal_cost, row.trade_balance, row.inserted
+            )
+            joined += int(row.inserted)
+            first, *repeats = waiters.get((row.signal_id, row.user_id), [])
+            if not first.done():
+                first.set_result(response)
+            # Повторные запросы того же пользователя в тот же сигнал
+            repeat = {"message": "User has already joined this signal", "success": False} if row.inserted else response
+            for future in repeats:
+                if not future.done():
+                    future.set_result(repeat)
+
+        # Пара, по которой запрос не вернул строку, не должна оставить запрос висеть
+        for futures in waiters.values():
+            for future in futures:
+                if not future.done():
+                    future.set_result({"message": "An error occurred while joining the signal", "success": False})
+
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.metrics["batches"] += 1
+        self.metrics["joined"] += joined
+        self.metrics["last_batch_size"] = len(batch)
+        self.metrics["last_batch_ms"] = elapsed_ms
+        self.metrics["max_batch_ms"] = max(self.metrics["max_batch_ms"], elapsed_ms)
+
+    async def _run(self):
+        while not self._stopping:
+            batch = await self._collect()
+            self._applying = True
+            try:
+                await self.apply(batch)
+            finally:
+                self._applying = False
+
+    async def stop(self):
+        """
+        Останавливает очередь: новые входы отклоняются, текущий пакет доприменяется,
+        остаток очереди применяется пакетами; future, оставшиеся без ответа, завершаются исключением.
+        """
+        self._stopping = True
+        if self._task is not None:
+            if not self._applying:
+                self._task.cancel()  # Задача ждёт очередь — собранные намерения останутся в _collecting
+            try:
+                await self._task  # Применяемый пакет доводится до конца
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        pending, self._collecting = self._collecting, []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for start in range(0, len(pending), self.batch_size):
+            await self.apply(pending[start:start + self.batch_size])
+
+        for _, _, future, _ in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("Join admission queue stopped"))
+
+    def get_metrics(self) -> dict:
+        return {**self.metrics, "enabled": JOIN_ADMISSION_QUEUE, "queue_depth": self.queue.qsize()}
+
+
+join_admission = JoinAdmissionQueue()
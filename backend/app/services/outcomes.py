@@ -0,0 +1,80 @@
+import os
+import secrets
+from typing import NamedTuple
+import numpy as np
+
+# Значения по умолчанию (в процентах), если у сигнала не задан собственный параметр.
+# В .env они заданы по-старому: BURN_CHANCE — доля (0.1 — 10%), PROFIT_PERCENT — множитель (1.01 — прибыль 1%).
+DEFAULT_BURN_CHANCE = float(os.getenv("BURN_CHANCE", 0.1)) * 100
+DEFAULT_PROFIT_PERCENT = (float(os.getenv("PROFIT_PERCENT", 1.01)) - 1) * 100
+
+
+class SignalOutcomes(NamedTuple):
+    signal_ids: list
+    seeds: list  # seed генератора каждого сигнала (сохраняется в signals.outcome_seed)
+    outcomes: list  # True — сигнал успешен
+    profit_rates: dict  # signal_id → доля прибыли от суммы инвестиции
+
+
+def new_seed() -> int:
+    """Случайный seed, помещающийся в BIGINT."""
+    return secrets.randbits(63)
+
+
+def as_fraction(values) -> np.ndarray:
+    """Переводит burn_chance / profit_percent сигналов в доли: в signals они всегда в процентах (4.0 — 4%)."""
+    return np.asarray(values, dtype=np.float64) / 100
+
+
+def outcome_draws(seeds: list) -> np.ndarray:
+    """
+    Первое значение U[0, 1) из потока PCG64 каждого сигнала — по нему определяется исход.
+
+    Генератор создаётся на каждый сигнал (цикл, не векторизация): сигналов в пакете единицы,
+    а поток по seed должен совпадать с replay_outcome.
+    """
+    return np.fromiter((np.random.Generator(np.random.PCG64(seed)).random() for seed in seeds),
+                       dtype=np.float64, count=len(seeds))
+
+
+def draw_outcomes(signals: list) -> SignalOutcomes:
+    """
+    Исходы пакета сигналов по их собственным burn_chance и profit_percent.
+
+    :param signals: Строки (id, burn_chance, profit_percent, outcome_seed); seed None — будет выдан новый.
+    """
+    signal_ids = [signal_id for signal_id, _, _, _ in signals]
+    seeds = [seed if seed is not None else new_seed() for _, _, _, seed in signals]
+
+    burn = as_fraction([DEFAULT_BURN_CHANCE if chance is None else chance for _, chance, _, _ in signals])
+    profit = as_fraction([
+        DEFAULT_PROFIT_PERCENT if percent is None else percent for _, _, percent, _ in signals
+    ])
+
+    outcomes = outcome_draws(seeds) >= burn
+    return SignalOutcomes(
+        signal_ids=signal_ids,
+        seeds=seeds,
+        outcomes=outcomes.tolist(),
+        profit_rates=dict(zip(signal_ids, profit.tolist())),
+    )
+
+
+def investment_profits(signal_ids: list, amounts: list, reinvest_pars: list, profit_rates: dict):
+    """
+    Прибыль и сумма реинвестирования по каждой инвестиции пакета.
+
+    :return: (profits, reinvested) — списки float, округлённые до 2 знаков.
+    """
+    amounts = np.asarray(amounts, dtype=np.float64)
+    rates = np.fromiter((profit_rates[signal_id] for signal_id in signal_ids), dtype=np.float64, count=len(signal_ids))
+    pars = np.asarray([par or 0 for par in reinvest_pars], dtype=np.float64)
+
+    profits = np.round(amounts * rates, 2)
+    reinvested = np.round(profits * pars / 100, 2)
+    return profits.tolist(), reinvested.tolist()
+
+
+def replay_outcome(seed: int, burn_chance: float) -> bool:
+    """Повторяет исход сигнала по сохранённому seed (для сверки)."""
+    return bool(outcome_draws([seed])[0] >= as_fraction([burn_chance])[0])
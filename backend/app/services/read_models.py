@@ -0,0 +1,115 @@
+from datetime import datetime
+from typing import NamedTuple, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+from app.models.models import AuthTokens, Balance, Referrals, User
+
+# Проекции для горячих GET-эндпоинтов: только нужные колонки одним запросом с одним соединением,
+# результат — кортеж, без ORM-объектов, identity map и загрузчиков связей.
+
+_Referrer = aliased(User)
+
+# telegram_id пригласившего — из собственной записи пользователя в referrals
+referrer_telegram_id = (
+    select(Referrals.referred_by)
+    .filter(Referrals.user_id == User.id)
+    .order_by(Referrals.id)
+    .limit(1)
+    .scalar_subquery()
+)
+
+
+class BalanceView(NamedTuple):
+    id: int
+    telegram_id: int
+    balance: Optional[float]
+    trade_balance: Optional[float]
+    frozen_balance: Optional[float]
+
+
+class UserView(NamedTuple):
+    id: int
+    telegram_id: int
+    username: str
+    first_name: str
+    last_name: str
+    language_code: str
+    is_bot: bool
+    photo_url: str
+    automod: bool
+    plan: int
+    reinvestements_par: int
+    in_work: int
+    created_at: datetime
+    updated_at: datetime
+    balance_id: Optional[int]  # None — у пользователя нет записи баланса
+    balance: Optional[float]
+    trade_balance: Optional[float]
+    frozen_balance: Optional[float]
+    earned_balance: Optional[float]
+    referrer_id: Optional[int]
+    referrer_telegram_id: Optional[int]
+    referrer_username: Optional[str]
+
+
+class AuthView(NamedTuple):
+    expires_at: datetime
+    telegram_id: Optional[int]  # None — токен есть, а пользователя уже нет
+    username: Optional[str]
+
+
+def balance_view_query(telegram_id: int):
+    return (
+        select(User.id, User.telegram_id, Balance.balance, Balance.trade_balance, Balance.frozen_balance)
+        .outerjoin(Balance, Balance.user_id == User.id)
+        .filter(User.telegram_id == telegram_id)
+        .limit(1)
+    )
+
+
+def user_view_query(telegram_id: int):
+    return (
+        select(
+            User.id, User.telegram_id, User.username, User.first_name, User.last_name, User.language_code,
+            User.is_bot, User.photo_url, User.automod, User.plan, User.reinvestements_par, User.in_work,
+            User.created_at, User.updated_at,
+            Balance.id, Balance.balance, Balance.trade_balance, Balance.frozen_balance, Balance.earned_balance,
+            _Referrer.id, _Referrer.telegram_id, _Referrer.username,
+        )
+        .outerjoin(Balance, Balance.user_id == User.id)
+        .outerjoin(_Referrer, _Referrer.telegram_id == referrer_telegram_id)
+        .filter(User.telegram_id == telegram_id)
+        .limit(1)
+    )
+
+
+def auth_view_query(token: str):
+    return (
+        select(AuthTokens.expires_at, User.telegram_id, User.username)
+        .outerjoin(User, User.telegram_id == AuthTokens.user_id)
+        .filter(AuthTokens.token == token)
+        .limit(1)
+    )
+
+
+async def get_balance_view(db: AsyncSession, telegram_id: int) -> Optional[BalanceView]:
+    row = (await db.execute(balance_view_query(telegram_id))).first()
+    return BalanceView(*row) if row else None
+
+
+async def get_user_view(db: AsyncSession, telegram_id: int) -> Optional[UserView]:
+    row = (await db.execute(user_view_query(telegram_id))).first()
+    return UserView(*row) if row else None
+
+
+async def get_auth_view(db: AsyncSession, token: str) -> Optional[AuthView]:
+    row = (await db.execute(auth_view_query(token))).first()
+    return AuthView(*row) if row else None
+
+
+def referrer_dict(user: UserView):
+    """Пригласивший в формате ответа API или None."""
+    if user.referrer_id is None:
+        return None
+    return {"id": user.referrer_id, "telegram_id": user.referrer_telegram_id, "username": user.referrer_username}
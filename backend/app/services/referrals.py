@@ -0,0 +1,198 @@
+import os
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Ограничение глубины дерева рефералов (защищает от слишком глубоких выборок)
+REFERRAL_TREE_MAX_DEPTH = int(os.getenv("REFERRAL_TREE_MAX_DEPTH", 20))
+
+# referral_closure хранит все пары (ancestor, descendant, depth) по telegram_id, включая (x, x, 0).
+# Поддерево, размер и количество по уровням — выборка по первичному ключу (ancestor, ...).
+
+_REFERRAL_TREE_ROWS = text("""
+    SELECT id, user_id, telegram_id, referral_link, invited_count, referrer_id, referred_by, depth
+    FROM (
+        SELECT r.*, c.depth,
+               row_number() OVER (PARTITION BY c.depth ORDER BY r.id) AS level_position
+        FROM referral_closure AS c
+        JOIN referrals AS r ON r.telegram_id = c.descendant
+        WHERE c.ancestor = CAST(:telegram_id AS BIGINT)
+          AND c.depth <= CAST(:max_depth AS INTEGER)
+    ) AS ranked
+    WHERE depth = 0
+       OR (level_position > CAST(:level_offset AS INTEGER)
+           AND (CAST(:level_limit AS INTEGER) IS NULL
+                OR level_position <= CAST(:level_offset AS INTEGER) + CAST(:level_limit AS INTEGER)))
+    ORDER BY depth, id
+""")
+
+_REFERRAL_LEVEL_COUNTS = text("""
+    SELECT depth, count(*) AS count
+    FROM referral_closure
+    WHERE ancestor = CAST(:telegram_id AS BIGINT)
+      AND depth <= CAST(:max_depth AS INTEGER)
+    GROUP BY depth
+    ORDER BY depth
+""")
+
+_IS_DESCENDANT = text("""
+    SELECT EXISTS (
+        SELECT 1 FROM referral_closure
+        WHERE ancestor = CAST(:ancestor AS BIGINT) AND descendant = CAST(:descendant AS BIGINT)
+    )
+""")
+
+_CURRENT_PARENT = text("""
+    SELECT ancestor FROM referral_closure
+    WHERE descendant = CAST(:telegram_id AS BIGINT) AND depth = 1
+""")
+
+_ENSURE_NODES = text("""
+    INSERT INTO referral_closure (ancestor, descendant, depth)
+    SELECT node, node, 0
+    FROM unnest(CAST(:telegram_ids AS BIGINT[])) AS node
+    ON CONFLICT (ancestor, descendant) DO NOTHING
+""")
+
+# Отвязываем поддерево от прежних предков (связи внутри поддерева сохраняются)
+_DETACH_SUBTREE = text("""
+    DELETE FROM referral_closure AS c
+    USING referral_closure AS sub
+    WHERE sub.ancestor = CAST(:telegram_id AS BIGINT)
+      AND c.descendant = sub.descendant
+      AND c.ancestor NOT IN (
+          SELECT descendant FROM referral_closure WHERE ancestor = CAST(:telegram_id AS BIGINT)
+      )
+""")
+
+# Каждый предок нового родителя (включая его самого) × каждый узел поддерева
+_ATTACH_SUBTREE = text("""
+    INSERT INTO referral_closure (ancestor, descendant, depth)
+    SELECT up.ancestor, sub.descendant, up.depth + sub.depth + 1
+    FROM referral_closure AS up
+    CROSS JOIN referral_closure AS sub
+    WHERE up.descendant = CAST(:parent AS BIGINT)
+      AND sub.ancestor = CAST(:telegram_id AS BIGINT)
+    ON CONFLICT (ancestor, descendant) DO UPDATE SET depth = EXCLUDED.depth
+""")
+
+# invited_count — число прямых приглашённых, всегда пересчитывается из referral_closure
+_REFRESH_INVITED_COUNT = text("""
+    UPDATE referrals AS r
+    SET invited_count = (
+        SELECT count(*) FROM referral_closure AS c
+        WHERE c.ancestor = r.telegram_id AND c.depth = 1
+    )
+    WHERE r.telegram_id = ANY(CAST(:telegram_ids AS BIGINT[]))
+""")
+
+
+def _node(row) -> dict:
+    return {
+        "id": row.id,
+        "user_id": row.user_id,
+        "telegram_id": row.telegram_id,
+        "referral_link": row.referral_link,
+        "invited_count": row.invited_count,
+        "referrer_id": row.referrer_id,
+        "referred_by": row.referred_by,
+        "invited_users": [],
+    }
+
+
+async def link_referral(db: AsyncSession, telegram_id: int, referred_by: int = None) -> bool:
+    """
+    Привязывает пользователя (вместе с его поддеревом) к пригласившему и обновляет referral_closure.
+
+    Подходит и для новой записи, и для перепривязки. Не коммитит — изменения фиксирует вызывающий код
+    вместе с самой записью Referrals.
+
+    :param telegram_id: Telegram ID приглашённого.
+    :param referred_by: Telegram ID пригласившего (None — пользователь без пригласившего).
+
+    :return: False, если привязка создала бы цикл (пригласивший находится в поддереве пользователя).
+    """
+    if referred_by is not None:
+        if referred_by == telegram_id:
+            return False
+        result = await db.execute(_IS_DESCENDANT, {"ancestor": telegram_id, "descendant": referred_by})
+        if result.scalar():
+            return False
+
+    result = await db.execute(_CURRENT_PARENT, {"telegram_id": telegram_id})
+    old_parent = result.scalar()
+
+    nodes = [telegram_id] if referred_by is None else [telegram_id, referred_by]
+    await db.execute(_ENSURE_NODES, {"telegram_ids": nodes})
+
+    if old_parent == referred_by:
+        return True
+
+    await db.execute(_DETACH_SUBTREE, {"telegram_id": telegram_id})
+    if referred_by is not None:
+        await db.execute(_ATTACH_SUBTREE, {"telegram_id": telegram_id, "parent": referred_by})
+
+    affected = [parent for parent in (old_parent, referred_by) if parent is not None]
+    if affected:
+        await db.execute(_REFRESH_INVITED_COUNT, {"telegram_ids": affected})
+    return True
+
+
+async def load_referral_tree(
+    db: AsyncSession,
+    telegram_id: int,
+    max_depth: int = REFERRAL_TREE_MAX_DEPTH,
+    level_limit: int = None,
+    level_offset: int = 0,
+):
+    """
+    Загружает дерево приглашённых одним запросом к referral_closure и собирает вложенную структуру за O(n).
+
+    :param telegram_id: Telegram ID корня дерева.
+    :param max_depth: Максимальная глубина (уровни ниже не загружаются).
+    :param level_limit: Сколько узлов брать на каждом уровне (None — все).
+    :param level_offset: Сколько узлов пропустить на каждом уровне.
+
+    :return: Корневой узел с вложенными invited_users или None, если корень не найден.
+    """
+    result = await db.execute(
+        _REFERRAL_TREE_ROWS,
+        {
+            "telegram_id": telegram_id,
+            "max_depth": min(max_depth, REFERRAL_TREE_MAX_DEPTH),
+            "level_limit": level_limit,
+            "level_offset": level_offset,
+        },
+    )
+
+    root = None
+    nodes = {}
+    for row in result.all():  # строки отсортированы по глубине — родитель всегда раньше детей
+        node = _node(row)
+        if row.depth == 0:
+            if root is not None:
+                continue  # дубликат записи Referrals с тем же telegram_id
+            root = node
+        else:
+            parent = nodes.get(row.referred_by)
+            if parent is None:
+                continue  # родитель не попал на страницу своего уровня
+            parent["invited_users"].append(node)
+        nodes[row.telegram_id] = node
+
+    return root
+
+
+async def referral_level_counts(db: AsyncSession, telegram_id: int, max_depth: int = REFERRAL_TREE_MAX_DEPTH):
+    """
+    Количество приглашённых на каждом уровне дерева (без загрузки самих узлов).
+
+    :return: Список {"depth", "count"} для уровней от 1 или None, если корень не найден.
+    """
+    result = await db.execute(
+        _REFERRAL_LEVEL_COUNTS,
+        {"telegram_id": telegram_id, "max_depth": min(max_depth, REFERRAL_TREE_MAX_DEPTH)},
+    )
+    rows = result.all()
+    if not rows:
+        return None
+    return [{"depth": depth, "count": count} for depth, count in rows if depth > 0]
@@ -0,0 +1,198 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models.models import Signal
+from app.roles import runs
+from app.services.cache_bus import cache_bus
+
+# Раз в столько секунд перечитываем необработанные сигналы из БД, что бы ни лежало в очереди
+# (сигналы из других процессов, пропущенные notify_signal после падения или отката)
+SCHEDULER_RELOAD_INTERVAL = int(os.getenv("SCHEDULER_RELOAD_INTERVAL", os.getenv("SCHEDULER_IDLE_RELOAD", 300)))
+# Через сколько секунд повторять задачу, завершившуюся ошибкой
+SCHEDULER_RETRY_DELAY = int(os.getenv("SCHEDULER_RETRY_DELAY", 10))
+
+# Виды задач планировщика
+SETTLE = "settle"  # сигнал истёк (expires_at) — нужно подвести итоги
+JOIN_CLOSED = "join_closed"  # закрылось окно входа в сигнал (join_until)
+AUTO_MODE = "auto_mode"  # цикл подключения пользователей с автомодом
+RELOAD = "reload"  # перечитать необработанные сигналы из БД
+
+# Отключаем SQLAlchemy INFO-логи
+logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
+logging.getLogger("sqlalchemy.pool").setLevel(logging.CRITICAL)
+
+# Основной логгер
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.ERROR)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+
+logger.addHandler(console_handler)
+
+
+class SignalScheduler:
+    """
+    Планировщик по дедлайнам: куча таймеров (deadline, kind, signal_id).
+
+    Спит ровно до ближайшего дедлайна и просыпается раньше, если добавлен более ранний таймер.
+    Для одного ключа (kind, signal_id) хранится только самый ранний дедлайн.
+    """
+
+    def __init__(self):
+        self.clock = lambda: datetime.now(timezone.utc)
+        self._heap = []
+        self._deadlines = {}  # (kind, signal_id) -> актуальный дедлайн
+        self._handlers = {}  # kind -> список корутин-обработчиков
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self.metrics = {
+            "fired": 0,
+            "failed": 0,
+            "last_lateness_s": 0.0,
+            "max_lateness_s": 0.0,
+        }
+
+    def configure(self, clock=None):
+        """Задаёт часы, в которых хранятся дедлайны сигналов."""
+        if clock is not None:
+            self.clock = clock
+
+    def on(self, kind: str, handler):
+        """Регистрирует обработчик: async handler(signal_ids: list)."""
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def schedule(self, when: datetime, kind: str, signal_id: int = None):
+        key = (kind, signal_id)
+        current = self._deadlines.get(key)
+        if current is not None and current <= when:
+            return
+
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._counter), kind, signal_id))
+
+        # Будим цикл, только если новый таймер стал ближайшим
+        if self._heap[0][2:] == (kind, signal_id):
+            self._wakeup.set()
+
+    def schedule_in(self, seconds: float, kind: str, signal_id: int = None):
+        self.schedule(self.clock() + timedelta(seconds=seconds), kind, signal_id)
+
+    def notify_signal(self, signal: Signal):
+        """
+        Вызывается при создании сигнала: ставит таймеры на join_until и expires_at.
+
+        Сигнал, созданный в процессе без роли scheduler (API), доходит до планировщика
+        через cache_bus (signal_created); если сообщение потеряно — через RELOAD.
+        """
+        if signal.is_successful is not None:
+            return
+        if runs("scheduler"):
+            self._schedule_signal(signal.id, signal.join_until, signal.expires_at)
+        cache_bus.publish("signal_created", [
+            signal.id,
+            signal.join_until.isoformat() if signal.join_until is not None else None,
+            signal.expires_at.isoformat() if signal.expires_at is not None else None,
+        ])
+
+    def on_signal_created(self, value):
+        """Сигнал создан в другом процессе (сообщение cache_bus signal_created)."""
+        signal_id, join_until, expires_at = value
+        self._schedule_signal(
+            signal_id,
+            datetime.fromisoformat(join_until) if join_until is not None else None,
+            datetime.fromisoformat(expires_at) if expires_at is not None else None,
+        )
+
+    def _schedule_signal(self, signal_id: int, join_until: datetime, expires_at: datetime):
+        if join_until is not None:
+            self.schedule(join_until, JOIN_CLOSED, signal_id)
+        if expires_at is not None:
+            self.schedule(expires_at, SETTLE, signal_id)
+        # Новый сигнал — повод сразу подключить пользователей с автомодом
+        self.schedule(self.clock(), AUTO_MODE)
+
+    async def load_pending(self, db: AsyncSession):
+        """Загружает таймеры всех необработанных сигналов из БД."""
+        result = await db.execute(
+            select(Signal.id, Signal.join_until, Signal.expires_at).filter(Signal.is_successful.is_(None))
+        )
+        now = self.clock()
+        for signal_id, join_until, expires_at in result.all():
+            if join_until is not None and join_until > now:
+                self.schedule(join_until, JOIN_CLOSED, signal_id)
+            if expires_at is not None:
+                self.schedule(expires_at, SETTLE, signal_id)
+
+    def _pop_due(self) -> dict:
+        now = self.clock()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            when, _, kind, signal_id = heapq.heappop(self._heap)
+            key = (kind, signal_id)
+            if self._deadlines.get(key) != when:
+                continue  # устаревшая запись — дедлайн был перенесён раньше
+            del self._deadlines[key]
+
+            lateness = (now - when).total_seconds()
+            self.metrics["last_lateness_s"] = round(lateness, 3)
+            self.metrics["max_lateness_s"] = max(self.metrics["max_lateness_s"], round(lateness, 3))
+            self.metrics["fired"] += 1
+
+            ids = due.setdefault(kind, [])
+            if signal_id is not None:
+                ids.append(signal_id)
+        return due
+
+    async def _dispatch(self, kind: str, signal_ids: list):
+        for handler in self._handlers.get(kind, []):
+            try:
+                await handler(signal_ids)
+            except Exception as e:
+                self.metrics["failed"] += 1
+                logging.error(f"Ошибка в задаче планировщика {kind} {signal_ids}: {e}")
+                # Повторяем задачу позже
+                for signal_id in signal_ids or [None]:
+                    self.schedule_in(SCHEDULER_RETRY_DELAY, kind, signal_id)
+
+    async def run(self):
+        """
+        Основной цикл планировщика.
+
+        Перечитывание сигналов из БД — обычная периодическая задача RELOAD (см. lifecycle.run_background_tasks).
+        """
+        while True:
+            if self._heap:
+                timeout = max((self._heap[0][0] - self.clock()).total_seconds(), 0)
+            else:
+                timeout = None  # Ждём первого таймера
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                continue  # появился более ранний таймер — пересчитываем ожидание
+            except asyncio.TimeoutError:
+                pass
+
+            for kind, signal_ids in self._pop_due().items():
+                await self._dispatch(kind, signal_ids)
+
+    def get_metrics(self) -> dict:
+        lateness = 0.0
+        if self._heap:
+            lateness = max((self.clock() - self._heap[0][0]).total_seconds(), 0.0)
+        return {
+            **self.metrics,
+            "queue_depth": len(self._deadlines),
+            "current_lateness_s": round(lateness, 3),
+        }
+
+
+signal_scheduler = SignalScheduler()
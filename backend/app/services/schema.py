@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.services.advisory_lock import AdvisoryLock
+
+SCHEMA_LOCK_KEY = int(os.getenv("SCHEMA_LOCK_KEY", 7402312))  # ключ advisory-блокировки проверки схемы
+SCHEMA_LOCK_RETRY = float(os.getenv("SCHEMA_LOCK_RETRY", 1))  # секунды между попытками взять блокировку
+
+# Индексы и служебные таблицы, которых нет в исходной схеме. Все операторы идемпотентны и выполняются при каждом старте.
+_SCHEMA_STATEMENTS = [
+    # Разовые заполнения данных (_DATA_MIGRATIONS), которые уже выполнены
+    """
+    CREATE TABLE IF NOT EXISTS schema_data_migrations (
+        name VARCHAR PRIMARY KEY,
+        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """,
+    # Переход от пригласившего к приглашённым в рекурсивном дереве рефералов
+    "CREATE INDEX IF NOT EXISTS ix_referrals_referred_by ON referrals (referred_by)",
+    "CREATE INDEX IF NOT EXISTS ix_referrals_telegram_id ON referrals (telegram_id)",
+    # Seed, по которому получен исход сигнала (services/outcomes.py)
+    "ALTER TABLE signals ADD COLUMN IF NOT EXISTS outcome_seed BIGINT",
+    # Постраничная и потоковая история пользователя: WHERE user_id = ? ORDER BY created_at, id
+    "CREATE INDEX IF NOT EXISTS ix_transactions_user_created ON transactions (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_profits_user_created ON profits (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_signal_investments_user_created ON signal_investments (user_id, created_at, id)",
+    # Один вход пользователя в сигнал; при уже существующих дублях индекс не создаётся (их нужно разобрать вручную)
+    """
+    DO $$
+    BEGIN
+        IF to_regclass('uq_signal_investments_signal_user') IS NOT NULL THEN
+            RETURN;  -- Индекс уже есть: таблицу на дубли не сканируем
+        END IF;
+        IF NOT EXISTS (
+            SELECT 1 FROM signal_investments GROUP BY signal_id, user_id HAVING count(*) > 1
+        ) THEN
+            CREATE UNIQUE INDEX IF NOT EXISTS uq_signal_investments_signal_user
+                ON signal_investments (signal_id, user_id);
+        ELSE
+            RAISE WARNING 'signal_investments has duplicate (signal_id, user_id) rows, unique index skipped';
+        END IF;
+    END
+    $$
+    """,
+    # referrals.referred_by хранит telegram_id пригласившего: старый FK на users.id заменяется FK на users.telegram_id
+    # (NOT VALID — старые строки не перепроверяются, новые записи проверяются)
+    """
+    DO $$
+    DECLARE
+        fk record;
+    BEGIN
+        FOR fk IN
+            SELECT c.conname
+            FROM pg_constraint AS c
+            JOIN pg_attribute AS a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            JOIN pg_attribute AS ref ON ref.attrelid = c.confrelid AND ref.attnum = ANY(c.confkey)
+            WHERE c.contype = 'f'
+              AND c.conrelid = 'referrals'::regclass
+              AND c.confrelid = 'users'::regclass
+              AND a.attname = 'referred_by'
+              AND ref.attname = 'id'
+        LOOP
+            EXECUTE format('ALTER TABLE referrals DROP CONSTRAINT %I', fk.conname);
+        END LOOP;
+
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_constraint
+            WHERE conrelid = 'referrals'::regclass AND conname = 'fk_referrals_referred_by_telegram_id'
+        ) THEN
+            ALTER TABLE referrals
+                ADD CONSTRAINT fk_referrals_referred_by_telegram_id
+                FOREIGN KEY (referred_by) REFERENCES users (telegram_id) NOT VALID;
+        END IF;
+    END
+    $$
+    """,
+    # Замыкание дерева рефералов: (предок, потомок, глубина) по telegram_id
+    """
+    CREATE TABLE IF NOT EXISTS referral_closure (
+        ancestor BIGINT NOT NULL,
+        descendant BIGINT NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor, descendant)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_referral_closure_descendant ON referral_closure (descendant, depth)",
+]
+
+# Разовые заполнения данных: выполняются один раз на базу и отмечаются в schema_data_migrations
+# в той же транзакции; порядок важен (invited_count считается по заполненному referral_closure).
+_DATA_MIGRATIONS = [
+    # burn_chance и profit_percent хранятся в процентах; статичные сигналы раньше записывались долями
+    # (profit 0.04–0.6, в процентах — от 4)
+    ("signals_percent_units", """
+    UPDATE signals
+    SET burn_chance = burn_chance * 100, profit_percent = profit_percent * 100
+    WHERE name LIKE 'Статичный сигнал%' AND profit_percent < 1
+    """),
+    # Дедлайны сигналов раньше записывались со сдвигом: UTC+3 ч (create_signal) и UTC+6 ч (статичные сигналы),
+    # авто-сигналы — без сдвига. Необработанные сигналы переводятся на реальные часы (те же, что now())
+    ("signals_real_clock", """
+    UPDATE signals
+    SET join_until = join_until - shift.value, expires_at = expires_at - shift.value
+    FROM (
+        SELECT s.id, CASE
+            WHEN s.name LIKE 'Статичный сигнал%' THEN interval '6 hours'
+            ELSE interval '3 hours'
+        END AS value
+        FROM signals AS s
+        WHERE s.is_successful IS NULL AND s.name <> 'Автоматический сигнал'
+    ) AS shift
+    WHERE signals.id = shift.id
+    """),
+    # Первичное заполнение referral_closure из referrals.referred_by (только если таблица пуста)
+    ("referral_closure_backfill", """
+    INSERT INTO referral_closure (ancestor, descendant, depth)
+    WITH RECURSIVE chain AS (
+        SELECT DISTINCT telegram_id AS ancestor, telegram_id AS descendant, 0 AS depth, ARRAY[telegram_id] AS path
+        FROM referrals
+      UNION ALL
+        SELECT ch.ancestor, r.telegram_id, ch.depth + 1, ch.path || r.telegram_id
+        FROM chain AS ch
+        JOIN referrals AS r ON r.referred_by = ch.descendant
+        WHERE NOT r.telegram_id = ANY(ch.path)
+    )
+    SELECT ancestor, descendant, min(depth)
+    FROM chain
+    WHERE NOT EXISTS (SELECT 1 FROM referral_closure)
+    GROUP BY ancestor, descendant
+    ON CONFLICT (ancestor, descendant) DO NOTHING
+    """),
+    # invited_count — производное от referral_closure (число прямых приглашённых)
+    ("referrals_invited_count", """
+    UPDATE referrals AS r
+    SET invited_count = c.invited
+    FROM (
+        SELECT r2.id, (
+            SELECT count(*) FROM referral_closure AS rc
+            WHERE rc.ancestor = r2.telegram_id AND rc.depth = 1
+        ) AS invited
+        FROM referrals AS r2
+    ) AS c
+    WHERE r.id = c.id AND r.invited_count IS DISTINCT FROM c.invited
+    """),
+]
+
+_CLAIM_MIGRATION = text("""
+    INSERT INTO schema_data_migrations (name) VALUES (CAST(:name AS VARCHAR))
+    ON CONFLICT (name) DO NOTHING
+    RETURNING name
+""")
+
+
+async def ensure_schema(db: AsyncSession):
+    """
+    Досоздаёт недостающие индексы и таблицы и выполняет ещё не применённые заполнения данных.
+
+    Проверка идёт под advisory-блокировкой: из всех процессов и воркеров схему меняет один, остальные ждут
+    и после него только убеждаются, что всё на месте (заполнения данных повторно не выполняются).
+    """
+    lock = AdvisoryLock(SCHEMA_LOCK_KEY)
+    while not await lock.try_acquire():
+        await asyncio.sleep(SCHEMA_LOCK_RETRY)
+    try:
+        for statement in _SCHEMA_STATEMENTS:
+            await db.execute(text(statement))
+
+        applied = []
+        for name, statement in _DATA_MIGRATIONS:
+            if (await db.execute(_CLAIM_MIGRATION, {"name": name})).first() is not None:
+                await db.execute(text(statement))
+                applied.append(name)
+        await db.commit()
+    finally:
+        await lock.release()
+    logging.info(
+        f"Схема БД проверена: {len(_SCHEMA_STATEMENTS)} операторов; заполнения данных: {', '.join(applied) or 'нет новых'}"
+    )
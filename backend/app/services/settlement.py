@@ -0,0 +1,290 @@
+import logging
+import os
+import time
+from datetime import datetime
+from sqlalchemy import BigInteger, Boolean, Float, Integer, bindparam, insert, text
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models.models import Profit, Signal
+from app.services.outcomes import draw_outcomes, investment_profits
+from app.statistics_services.ledger import log_transactions
+
+# Получаем параметры из .env
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", 50))
+# Доли прибыли приглашённого, начисляемые пригласившим по уровням: "0.01" — только первый уровень 1%,
+# "0.05,0.02,0.01" — три уровня
+REFERRAL_BONUS_LEVELS = [float(rate) for rate in os.getenv("REFERRAL_BONUS_LEVELS", "0.01").split(",") if rate.strip()]
+
+# Отключаем SQLAlchemy INFO-логи
+logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
+logging.getLogger("sqlalchemy.pool").setLevel(logging.CRITICAL)
+
+# Основной логгер
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.ERROR)
+
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.ERROR)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+
+logger.addHandler(console_handler)
+
+# Статистика последнего обработанного пакета (для мониторинга)
+last_batch_stats: dict = {}
+
+#-------------------------------------------------------------------------#
+
+# Проставляем результат сразу всем сигналам пакета вместе с seed, по которому он получен
+_MARK_SIGNALS = text("""
+    UPDATE signals AS s
+    SET is_successful = o.success, outcome_seed = o.seed
+    FROM unnest(
+        CAST(:signal_ids AS INTEGER[]), CAST(:outcomes AS BOOLEAN[]), CAST(:seeds AS BIGINT[])
+    ) AS o(signal_id, success, seed)
+    WHERE s.id = o.signal_id
+""").bindparams(
+    bindparam("signal_ids", type_=ARRAY(Integer)),
+    bindparam("outcomes", type_=ARRAY(Boolean)),
+    bindparam("seeds", type_=ARRAY(BigInteger)),
+)
+
+# Закрываем все непроверенные инвестиции пакета и сразу возвращаем данные для расчёта
+_SETTLE_INVESTMENTS = text("""
+    UPDATE signal_investments AS si
+    SET is_checked = TRUE, profit = o.success
+    FROM unnest(CAST(:signal_ids AS INTEGER[]), CAST(:outcomes AS BOOLEAN[])) AS o(signal_id, success), users AS u
+    WHERE si.signal_id = o.signal_id
+      AND si.is_checked = FALSE
+      AND u.id = si.user_id
+    RETURNING si.user_id, si.signal_id, si.amount, o.success, u.reinvestements_par
+""").bindparams(
+    bindparam("signal_ids", type_=ARRAY(Integer)),
+    bindparam("outcomes", type_=ARRAY(Boolean)),
+)
+
+# Заморозка: переносим сумму с основного баланса только при достаточном остатке
+_FREEZE_BALANCES = text("""
+    UPDATE balances AS b
+    SET balance = b.balance - d.amount,
+        frozen_balance = b.frozen_balance + d.amount
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:amounts AS DOUBLE PRECISION[])) AS d(user_id, amount)
+    WHERE b.user_id = d.user_id AND b.balance >= d.amount
+    RETURNING b.user_id
+""").bindparams(
+    bindparam("user_ids", type_=ARRAY(Integer)),
+    bindparam("amounts", type_=ARRAY(Float)),
+)
+
+# Реинвестирование в торговый баланс
+_REINVEST_BALANCES = text("""
+    UPDATE balances AS b
+    SET trade_balance = b.trade_balance + d.amount
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:amounts AS DOUBLE PRECISION[])) AS d(user_id, amount)
+    WHERE b.user_id = d.user_id
+""").bindparams(
+    bindparam("user_ids", type_=ARRAY(Integer)),
+    bindparam("amounts", type_=ARRAY(Float)),
+)
+
+# Уменьшаем счётчик сигналов в работе
+_RELEASE_IN_WORK = text("""
+    UPDATE users AS u
+    SET in_work = GREATEST(u.in_work - d.settled, 0)
+    FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:counts AS INTEGER[])) AS d(user_id, settled)
+    WHERE u.id = d.user_id AND u.in_work > 0
+""").bindparams(
+    bindparam("user_ids", type_=ARRAY(Integer)),
+    bindparam("counts", type_=ARRAY(Integer)),
+)
+
+# Реферальные бонусы: прибыль каждого пользователя × ставка уровня для всех его предков из referral_closure,
+# сумма по каждому пригласившему зачисляется на основной баланс одним UPDATE
+_CREDIT_REFERRAL_BONUSES = text("""
+    UPDATE balances AS b
+    SET balance = b.balance + bonus.amount
+    FROM (
+        SELECT ru.id AS user_id, round(CAST(sum(e.profit * lvl.rate) AS NUMERIC), 2) AS amount
+        FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:profits AS DOUBLE PRECISION[])) AS e(user_id, profit)
+        JOIN users AS u ON u.id = e.user_id
+        JOIN referral_closure AS c ON c.descendant = u.telegram_id AND c.depth > 0
+        JOIN unnest(CAST(:rates AS DOUBLE PRECISION[])) WITH ORDINALITY AS lvl(rate, depth) ON lvl.depth = c.depth
+        JOIN users AS ru ON ru.telegram_id = c.ancestor
+        GROUP BY ru.id
+    ) AS bonus
+    WHERE b.user_id = bonus.user_id AND bonus.amount > 0
+    RETURNING b.user_id, CAST(bonus.amount AS DOUBLE PRECISION)
+""").bindparams(
+    bindparam("user_ids", type_=ARRAY(Integer)),
+    bindparam("profits", type_=ARRAY(Float)),
+    bindparam("rates", type_=ARRAY(Float)),
+)
+
+#-------------------------------------------------------------------------#
+
+async def credit_referral_bonuses(db: AsyncSession, earnings: dict) -> dict:
+    """
+    Начисляет пригласившим (на всех уровнях REFERRAL_BONUS_LEVELS) бонусы с прибыли приглашённых.
+
+    Не коммитит и не пишет журнал — это делает вызывающий код в своей транзакции.
+
+    :param earnings: user_id → прибыль пользователя.
+    :return: user_id пригласившего → зачисленный бонус.
+    """
+    earnings = {user_id: profit for user_id, profit in earnings.items() if profit > 0}
+    if not earnings or not REFERRAL_BONUS_LEVELS:
+        return {}
+
+    result = await db.execute(
+        _CREDIT_REFERRAL_BONUSES,
+        {"user_ids": list(earnings), "profits": list(earnings.values()), "rates": REFERRAL_BONUS_LEVELS},
+    )
+    return dict(result.all())
+
+
+async def settle_signal_batch(db: AsyncSession, now: datetime, batch_size: int = SETTLEMENT_BATCH_SIZE) -> dict:
+    """
+    Обрабатывает пакет истёкших сигналов набором массовых запросов в одной транзакции.
+
+    :param db: Асинхронная сессия SQLAlchemy.
+    :param now: Текущее время, с которым сравнивается expires_at.
+    :param batch_size: Максимальное количество сигналов в пакете.
+
+    :return: Статистика пакета (количество сигналов, инвестиций, пользователей и время обработки).
+    """
+    started = time.perf_counter()
+
+    try:
+        # 1️⃣ Забираем пакет сигналов (параллельные обработчики пропускают заблокированные строки)
+        result = await db.execute(
+            select(Signal.id, Signal.burn_chance, Signal.profit_percent, Signal.outcome_seed)
+            .filter(Signal.expires_at <= now, Signal.is_successful.is_(None))
+            .order_by(Signal.expires_at)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        signals = result.all()
+
+        if not signals:
+            await db.rollback()
+            return {"signals": 0, "investments": 0, "users": 0, "frozen_users": 0, "referrers": 0, "elapsed_ms": 0.0}
+
+        # 2️⃣ Исход каждого сигнала — по его burn_chance из воспроизводимого потока (seed сохраняется)
+        drawn = draw_outcomes(signals)
+        signal_ids = drawn.signal_ids
+        params = {"signal_ids": signal_ids, "outcomes": drawn.outcomes}
+
+        await db.execute(_MARK_SIGNALS, {**params, "seeds": drawn.seeds})
+        settled = (await db.execute(_SETTLE_INVESTMENTS, params)).all()
+
+        # 3️⃣ Прибыль по всем инвестициям пакета (по profit_percent сигнала) и движения по пользователям
+        profits, reinvestments = investment_profits(
+            [row.signal_id for row in settled],
+            [row.amount for row in settled],
+            [row.reinvestements_par for row in settled],
+            drawn.profit_rates,
+        )
+
+        profit_rows = []
+        frozen = {}
+        reinvested = {}
+        earned = {}
+        settled_count = {}
+
+        for (user_id, signal_id, amount, success, _), profit, reinvestment_amount in zip(settled, profits, reinvestments):
+            profit_rows.append({
+                "user_id": user_id,
+                "signal_id": signal_id,
+                "amount": amount,  # Исходная сумма
+                "profit": profit,
+                "reinvested_amount": reinvestment_amount,
+            })
+            settled_count[user_id] = settled_count.get(user_id, 0) + 1
+
+            if success:
+                frozen[user_id] = frozen.get(user_id, 0.0) + amount + profit
+                reinvested[user_id] = reinvested.get(user_id, 0.0) + reinvestment_amount
+                earned[user_id] = earned.get(user_id, 0.0) + profit
+
+        frozen_users = []
+        ledger_rows = []
+
+        # 4️⃣ Массово применяем изменения балансов
+        if frozen:
+            result = await db.execute(
+                _FREEZE_BALANCES,
+                {"user_ids": list(frozen), "amounts": list(frozen.values())},
+            )
+            frozen_users = list(result.scalars().all())
+            ledger_rows.extend(
+                {"user_id": user_id, "amount": frozen[user_id], "transaction_type": "freeze"}
+                for user_id in frozen_users
+            )
+
+        reinvested = {user_id: amount for user_id, amount in reinvested.items() if amount}
+        if reinvested:
+            await db.execute(
+                _REINVEST_BALANCES,
+                {"user_ids": list(reinvested), "amounts": list(reinvested.values())},
+            )
+            ledger_rows.extend(
+                {"user_id": user_id, "amount": amount, "transaction_type": "trade_balance_update"}
+                for user_id, amount in reinvested.items()
+            )
+
+        if settled_count:
+            await db.execute(
+                _RELEASE_IN_WORK,
+                {"user_ids": list(settled_count), "counts": list(settled_count.values())},
+            )
+
+        # 5️⃣ Реферальные бонусы с прибыли всего пакета — одним запросом по referral_closure
+        bonuses = await credit_referral_bonuses(db, earned)
+        ledger_rows.extend(
+            {"user_id": user_id, "amount": amount, "transaction_type": "referral_bonus"}
+            for user_id, amount in bonuses.items()
+        )
+
+        # 6️⃣ Записи о прибыли и журнал транзакций — многострочными INSERT
+        if profit_rows:
+            await db.execute(insert(Profit), profit_rows)
+        if ledger_rows:
+            await log_transactions(db, ledger_rows)
+
+        await db.commit()
+
+    except Exception as e:
+        await db.rollback()
+        logging.error(f"Ошибка при пакетной обработке сигналов: {e}")
+        raise
+
+    stats = {
+        "signals": len(signal_ids),
+        "investments": len(profit_rows),
+        "users": len(settled_count),
+        "frozen_users": len(frozen_users),
+        "referrers": len(bonuses),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+    last_batch_stats.clear()
+    last_batch_stats.update(stats)
+
+    logging.info(
+        f"Пакет сигналов обработан: сигналов {stats['signals']}, инвестиций {stats['investments']}, "
+        f"пользователей {stats['users']}, за {stats['elapsed_ms']} мс"
+    )
+    return stats
+
+
+async def settle_expired_signals(db: AsyncSession, now: datetime, batch_size: int = SETTLEMENT_BATCH_SIZE) -> list:
+    """Обрабатывает все истёкшие сигналы пакетами, возвращает статистику по каждому пакету."""
+    batches = []
+    while True:
+        stats = await settle_signal_batch(db, now, batch_size)
+        if not stats["signals"]:
+            break
+        batches.append(stats)
+        if stats["signals"] < batch_size:
+            break
+    return batches
@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.sql import func
+from app.models.models import Signal
+from app.services.cache_bus import cache_bus
+
+# Сколько сигналов доступно пользователю в зависимости от плана
+PLAN_SIGNAL_LIMITS = {0: 2, 1: 4, 2: 5}
+DEFAULT_SIGNAL_LIMIT = 2
+
+
+class ActiveSignalsFeed:
+    """
+    Общий версионированный снимок сигналов, в которые можно войти.
+
+    Снимок перестраивается только после invalidate() (создание, закрытие окна входа, обработка сигналов);
+    запросы пользователей режут его по плану без обращения к БД.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._signals = []  # список dict, отсортирован по id
+        self._dirty = True
+        self._lock = asyncio.Lock()
+        self.metrics = {"rebuilds": 0, "hits": 0}
+
+    def invalidate(self, broadcast: bool = True):
+        self._dirty = True
+        if broadcast:
+            cache_bus.publish("signal_feed")  # Снимки API-процессов тоже устарели
+
+    async def _rebuild(self, db: AsyncSession):
+        result = await db.execute(
+            select(Signal)
+            .filter(Signal.join_until > func.now(), Signal.is_successful.is_(None))  # Обработанный сигнал закрыт
+            .order_by(Signal.id)
+        )
+        self._signals = [
+            {
+                "signal_id": signal.id,
+                "name": signal.name,
+                "join_until": signal.join_until,
+                "burn_chance": signal.burn_chance,
+                "expires_at": signal.expires_at,
+                "signal_cost": signal.signal_cost,
+                "profit_percent": signal.profit_percent
+            }
+            for signal in result.scalars().all()
+        ]
+        self.version += 1
+        self._dirty = False
+        self.metrics["rebuilds"] += 1
+        logging.info(f"Снимок активных сигналов перестроен: версия {self.version}, сигналов {len(self._signals)}")
+
+    async def get(self, db: AsyncSession, plan: int):
+        """
+        Возвращает активные сигналы для плана пользователя и ETag ответа.
+
+        :return: (список сигналов, etag)
+        """
+        if self._dirty:
+            async with self._lock:
+                if self._dirty:  # другой запрос мог уже перестроить снимок
+                    await self._rebuild(db)
+        else:
+            self.metrics["hits"] += 1
+
+        # Окно входа могло закрыться после построения снимка
+        now = datetime.now(timezone.utc)
+        limit = PLAN_SIGNAL_LIMITS.get(plan, DEFAULT_SIGNAL_LIMIT)
+        signals = [signal for signal in self._signals if signal["join_until"] > now][:limit]
+
+        ids = ",".join(str(signal["signal_id"]) for signal in signals)
+        etag = '"' + hashlib.md5(f"{self.version}:{ids}".encode()).hexdigest() + '"'
+        return signals, etag
+
+    def get_metrics(self) -> dict:
+        return {**self.metrics, "version": self.version, "size": len(self._signals), "dirty": self._dirty}
+
+
+signal_feed = ActiveSignalsFeed()
+cache_bus.on("signal_feed", lambda _: signal_feed.invalidate(broadcast=False))
+cache_bus.on_reset(lambda: signal_feed.invalidate(broadcast=False))
@@ -1,19 +1,19 @@
 import logging
 import os
 import random
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from fastapi import HTTPException
 import pytz
-from sqlalchemy import text
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
-from app.models.models import Profit, Signal, SignalInvestment, Balance, User
-from app.services.balances import freeze_balance, unfreeze_balance, update_trading_balance
+from app.models.models import Signal, Balance
+from app.services.settlement import settle_expired_signals, credit_referral_bonuses
+from app.statistics_services.ledger import log_transactions
+from app.services.scheduler import signal_scheduler
+from app.services.signal_feed import signal_feed
 
 # Получаем параметры из .env
-PROFIT_PERCENT = float(os.getenv("PROFIT_PERCENT", 1.01))
-BURN_CHANCE = float(os.getenv("BURN_CHANCE", 0.1))
 JOIN_TIME = int(os.getenv("JOIN_TIME", 300))
 ACTIVE_TIME = int(os.getenv("ACTIVE_TIME", 1800))
 
@@ -21,8 +21,20 @@ logging.getLogger("sqlalchemy.engine").setLevel(logging.CRITICAL)
 logging.getLogger("sqlalchemy.pool").setLevel(logging.CRITICAL)
 MAX_SECONDS = 10 * 365 * 24 * 60 * 60
 
+# Пул статичных сигналов: фиксированное число слотов с постоянными именами
+STATIC_SIGNAL_SLOTS = int(os.getenv("STATIC_SIGNAL_SLOTS", 9))
+STATIC_SIGNAL_PREFIX = "Статичный сигнал"
+
+MOSCOW_TZ = pytz.timezone("Europe/Moscow")
+
 def current_moscow_time():
-    return datetime.now(timezone.utc) + timedelta(hours=3)
+    """
+    Текущий момент в часовом поясе Москвы.
+
+    Колонки сигналов — timestamptz, поэтому это тот же момент, что now() в PostgreSQL:
+    вход, лента и обработка сигналов сравнивают дедлайны по одним часам.
+    """
+    return datetime.now(MOSCOW_TZ)
 
 async def create_signal(
     db: AsyncSession,
@@ -51,6 +63,8 @@ async def create_signal(
         )
         db.add(signal)
         await db.commit()
+        signal_scheduler.notify_signal(signal)  # Планировщик проснётся ровно к join_until / expires_at
+        signal_feed.invalidate()
         return signal
     except Exception as e:
         await db.rollback()
@@ -58,19 +72,36 @@ async def create_signal(
         raise e
 
 
+def static_signal_name(slot: int) -> str:
+    return f"{STATIC_SIGNAL_PREFIX} {slot}"
+
+
 async def create_static_signals(db: AsyncSession):
+    """
+    Поддерживает фиксированный пул статичных сигналов.
+
+    Пересоздаются только слоты, у которых нет действующего сигнала (истёк expires_at);
+    замены вставляются одним многострочным INSERT. Старые сигналы и последовательность ID не трогаем.
+    """
     try:
-        # Удаляем старые статичные сигналы
-        await db.execute(text("DELETE FROM signals WHERE name LIKE 'Статичный сигнал%'"))
-        await db.commit()
+        slot_names = [static_signal_name(slot) for slot in range(1, STATIC_SIGNAL_SLOTS + 1)]
 
-        # Сбрасываем последовательность ID
-        await db.execute(text("SELECT setval(pg_get_serial_sequence('signals', 'id'), COALESCE(MAX(id), 1), false) FROM signals"))
-        await db.commit()
+        # Слоты, у которых ещё есть действующий сигнал
+        result = await db.execute(
+            select(Signal.name)
+            .filter(Signal.name.in_(slot_names), Signal.expires_at > current_moscow_time())
+            .distinct()
+        )
+        live_slots = set(result.scalars().all())
+        expired_slots = [name for name in slot_names if name not in live_slots]
+
+        if not expired_slots:
+            return []
 
-        for i in range(9):
-            profit = random.uniform(4, 60) / 100  # Переводим процент прибыли в доли (от 0.04 до 0.6)
-            risk = min(0.1 + profit * 1.2, 0.95)  # Пропорционально увеличиваем риск (максимум 95%)
+        rows = []
+        for name in expired_slots:
+            profit = random.uniform(4, 60)  # Процент прибыли (от 4 до 60), как у остальных сигналов
+            risk = min(10 + profit * 1.2, 95)  # Пропорционально увеличиваем риск (максимум 95%)
 
             work_time = 20 * 60  # 20 минут
             signal_cost = random.randint(100, 200)  # Стоимость сигнала
@@ -79,22 +110,35 @@ async def create_static_signals(db: AsyncSession):
             active_time = work_time  # Время истечения
 
             # Текущее московское время
-            current_time = current_moscow_time() + timedelta(hours=3)
-
-            # Создаем сигнал
-            signal = Signal(
-                name=f"Статичный сигнал {i + 1}",
-                join_until=current_time + timedelta(seconds=join_time),
-                expires_at=current_time + timedelta(seconds=active_time),
-                burn_chance=risk,
-                profit_percent=profit,
-                signal_cost=signal_cost
-            )
-            db.add(signal)
-
+            current_time = current_moscow_time()
+
+            rows.append({
+                "name": name,
+                "join_until": current_time + timedelta(seconds=join_time),
+                "expires_at": current_time + timedelta(seconds=active_time),
+                "burn_chance": risk,
+                "profit_percent": profit,
+                "signal_cost": signal_cost,
+            })
+
+        # Все замены — одним запросом
+        result = await db.execute(
+            insert(Signal)
+            .values(rows)
+            .returning(Signal.id, Signal.name, Signal.join_until, Signal.expires_at, Signal.is_successful)
+        )
+        signals = result.all()
         await db.commit()
 
+        for signal in signals:
+            signal_scheduler.notify_signal(signal)
+        signal_feed.invalidate()
+
+        logging.info(f"Пересозданы статичные сигналы: {', '.join(expired_slots)}")
+        return signals
+
     except Exception as e:
+        await db.rollback()
         logging.error(f"Ошибка при создании статичных сигналов: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при создании статичных сигналов: {e}")
 
@@ -104,72 +148,14 @@ async def process_signals(db: AsyncSession):
     now = current_moscow_time()
 
     try:
-        
-        # Получаем сигналы, которые еще не были обработаны
-        result = await db.execute(
-            select(Signal).options(joinedload(Signal.investments))
-            .filter(Signal.expires_at <= now, Signal.is_successful.is_(None))
-        )
-        signals = result.unique().scalars().all()
-        
-
-        for signal in signals:
-            success = random.random() > BURN_CHANCE
-            signal.is_successful = success
-
-
-            for investment in signal.investments:
-                if investment.is_checked:
-                    continue
-
-                user_id = investment.user_id
-                amount = investment.amount
-
-                # Получаем пользователя для получения информации о его балансе и reinvestments_par
-                user_result = await db.execute(select(User).filter(User.id == user_id))
-                user = user_result.scalars().first()
-
-                if not user:
-                    logging.warning(f"\n\n\n⚠️ Пользователь {user_id} не найден, пропускаем")
-                    continue
-
-                profit = round(amount * (PROFIT_PERCENT - 1), 2)  # Округление до 2 знаков
-                total_earned = amount + profit
-                reinvestment_amount = round((profit * user.reinvestements_par) / 100, 2)  # Округление
-
-
-                if success:
-                    await freeze_balance(db, user_id, total_earned)
-                    await update_trading_balance(db, user_id, reinvestment_amount)
+        # Обрабатываем истёкшие сигналы пакетами: каждый пакет — одна транзакция из нескольких массовых запросов
+        batches = await settle_expired_signals(db, now)
 
-                # Запись в Profit
-                profit_entry = Profit(
-                    user_id=user_id,
-                    signal_id=signal.id,
-                    amount=amount,  # Записываем исходную сумму
-                    profit=profit,  # Прибыль
-                    reinvested_amount=reinvestment_amount
-                )
-                db.add(profit_entry)
-
-                # Записываем успешность сигнала в SignalInvestment
-                investment.profit = success  # Устанавливаем успешность инвестиции
-                db.add(investment)  # Добавляем инвестицию в транзакцию для коммита
-
-                if user.in_work > 0 and user.in_work <= user.plan:
-                    investment.in_work -= 1
-                    user.in_work -= 1
-
-                investment.is_checked = True  # Отмечаем инвестицию как проверенную
-
-            # Если сигнал неуспешен, просто записываем False в profit для всех не проверенных инвестиций
-            if not success:
-                for investment in signal.investments:
-                    if not investment.is_checked:
-                        investment.profit = False
-                        db.add(investment)  # Запись изменений в коммит
-
-        await db.commit()  # Сохраняем изменения в базе данных
+        if batches:
+            signal_feed.invalidate()
+            total_investments = sum(batch["investments"] for batch in batches)
+            total_ms = sum(batch["elapsed_ms"] for batch in batches)
+            logging.info(f"Обработано пакетов: {len(batches)}, инвестиций: {total_investments}, за {round(total_ms, 2)} мс")
 
         # Перезапускаем создание статичных сигналов после обработки всех сигналов
         await create_static_signals(db)
@@ -188,25 +174,14 @@ async def update_earned_balance(db: AsyncSession, user_id: int, earned_amount: f
     
     balance.earned_balance += earned_amount
     balance.balance += earned_amount
+    await process_referral_bonus(db, user_id, earned_amount)
     await db.commit()
-    await process_referral_bonus(db, user_id)
 
-async def process_referral_bonus(db: AsyncSession, user_id: int):
-    user_result = await db.execute(select(User).filter(User.id == user_id))
-    user = user_result.scalars().first()
-    if not user or not user.referred_by_id:
-        return
-    
-    referrer_id = user.referred_by_id
-    balance_result = await db.execute(select(Balance).filter(Balance.user_id == user_id))
-    balance = balance_result.scalars().first()
-    if not balance:
-        return
-    
-    referral_bonus = balance.earned_balance * 0.01
-    if referral_bonus > 0:
-        ref_balance_result = await db.execute(select(Balance).filter(Balance.user_id == referrer_id))
-        ref_balance = ref_balance_result.scalars().first()
-        if ref_balance:
-            ref_balance.balance += referral_bonus
-            await db.commit()
+async def process_referral_bonus(db: AsyncSession, user_id: int, earned_amount: float):
+    """Начисляет пригласившим пользователя бонусы с его прибыли (без коммита)."""
+    bonuses = await credit_referral_bonuses(db, {user_id: earned_amount})
+    if bonuses:
+        await log_transactions(db, [
+            {"user_id": referrer_id, "amount": amount, "transaction_type": "referral_bonus"}
+            for referrer_id, amount in bonuses.items()
+        ])
@@ -0,0 +1,111 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Optional
+from app.services.token_store import TokenEntry
+from app.services.cache_bus import cache_bus
+
+# Режим токенов входа: store — строки auth_tokens (с кэшем в памяти), signed — подписанные токены без базы
+AUTH_MODE = os.getenv("AUTH_MODE", "store").lower()
+SECRET_KEY = os.getenv("SECRET_KEY")
+
+if AUTH_MODE == "signed" and not SECRET_KEY:
+    raise ValueError("SECRET_KEY не задан в .env файле, а AUTH_MODE=signed!")
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _signature(payload: str) -> str:
+    return _b64encode(hmac.new(SECRET_KEY.encode(), payload.encode(), hashlib.sha256).digest())
+
+
+class RevocationSet:
+    """Отозванные (вышедшие из системы) подписанные токены: jti → exp, пока токен не истечёт сам."""
+
+    def __init__(self):
+        self._revoked = {}
+        self.metrics = {"revoked": 0, "rejected": 0, "pruned": 0}
+
+    def add(self, jti: str, exp: int):
+        self.prune()
+        self._revoked[jti] = exp
+        self.metrics["revoked"] += 1
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def prune(self, now: float = None) -> int:
+        """Удаляет записи об истёкших токенах — они отклоняются и без отзыва."""
+        now = now or time.time()
+        expired = [jti for jti, exp in self._revoked.items() if exp <= now]
+        for jti in expired:
+            del self._revoked[jti]
+        self.metrics["pruned"] += len(expired)
+        return len(expired)
+
+    def get_metrics(self) -> dict:
+        return {**self.metrics, "mode": AUTH_MODE, "size": len(self._revoked)}
+
+
+revocations = RevocationSet()
+cache_bus.on("token_revoked", lambda value: revocations.add(*value))
+
+
+def issue_signed_token(telegram_id: int, username: Optional[str], expires_at: datetime) -> str:
+    """
+    Подписанный токен: base64url(JSON {tid, usr, exp, jti}) + "." + base64url(HMAC-SHA256).
+
+    Содержит всё, что отдаёт /api/auth, поэтому проверка не обращается к базе.
+    """
+    payload = _b64encode(json.dumps(
+        {"tid": telegram_id, "usr": username, "exp": int(expires_at.timestamp()), "jti": secrets.token_urlsafe(8)},
+        separators=(",", ":"),
+    ).encode())
+    return f"{payload}.{_signature(payload)}"
+
+
+def _decode(token: str) -> Optional[dict]:
+    """Полезная нагрузка токена с верной подписью или None (срок и отзыв не проверяются)."""
+    payload, _, signature = token.partition(".")
+    if not payload or not signature or not hmac.compare_digest(signature.encode(), _signature(payload).encode()):
+        return None
+    try:
+        return json.loads(_b64decode(payload))
+    except ValueError:  # подпись верна, но полезная нагрузка повреждена
+        return None
+
+
+def verify_signed_token(token: str) -> Optional[TokenEntry]:
+    """
+    Проверка подписанного токена только вычислениями: подпись, срок, отзыв.
+
+    :return: TokenEntry или None, если подпись неверна, срок истёк или токен отозван.
+    """
+    claims = _decode(token)
+    if claims is None or claims["exp"] <= time.time():
+        return None
+    if claims["jti"] in revocations:
+        revocations.metrics["rejected"] += 1
+        return None
+    return TokenEntry(claims["tid"], claims["usr"], datetime.fromtimestamp(claims["exp"], timezone.utc))
+
+
+def revoke_signed_token(token: str) -> bool:
+    """Отзыв токена при выходе; False — токен и так недействителен."""
+    claims = _decode(token)
+    if claims is None or claims["exp"] <= time.time():
+        return False
+    revocations.add(claims["jti"], claims["exp"])
+    cache_bus.publish("token_revoked", [claims["jti"], claims["exp"]])  # Отзыв действует во всех процессах
+    return True
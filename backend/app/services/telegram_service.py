@@ -6,6 +6,9 @@ from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.models.models import User
 from app.models.models import AuthTokens
+from app.services.token_store import token_store
+from app.services.cache_bus import cache_bus
+from app.services.signed_tokens import AUTH_MODE, issue_signed_token
 
 # Настройка логирования
 #logger = logging.getLogger(__name__)
@@ -42,6 +45,10 @@ async def generate_auth_token(db: AsyncSession, telegram_id: int) -> str:
         if not user:
             raise ValueError(f"Пользователь с telegram_id {telegram_id} не найден в базе данных.")
 
+        if AUTH_MODE == "signed":
+            # Подписанный токен проверяется без базы — строка в auth_tokens не нужна
+            return issue_signed_token(telegram_id, user.username, datetime.now(MOSCOW_TZ) + TOKEN_EXPIRATION)
+
         # Проверяем, есть ли уже активный токен для пользователя
         existing_token = await db.execute(select(AuthTokens).filter(AuthTokens.user_id == telegram_id))
         existing_token = existing_token.scalars().first()
@@ -63,6 +70,8 @@ async def generate_auth_token(db: AsyncSession, telegram_id: int) -> str:
 
         # Сохраняем изменения в базе данных
         await db.commit()
+        token_store.put(new_token, telegram_id, user.username, expiration_time_msk)  # Запись в кэш токенов
+        cache_bus.publish("auth_token_user", telegram_id)  # Прежний токен в других процессах недействителен
 
         return new_token
 
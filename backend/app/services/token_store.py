@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.database import AsyncSessionLocal
+from app.models.models import AuthTokens, User
+from app.services.read_models import get_auth_view
+from app.services.cache_bus import cache_bus
+
+TOKEN_WHEEL_SLOT = int(os.getenv("TOKEN_WHEEL_SLOT", 60))  # секунды на одно деление колеса
+TOKEN_WHEEL_SLOTS = int(os.getenv("TOKEN_WHEEL_SLOTS", 120))  # делений (полный оборот — 2 часа при слоте 60 с)
+TOKEN_SWEEP_INTERVAL = float(os.getenv("TOKEN_SWEEP_INTERVAL", 300))  # секунды между очистками auth_tokens
+
+_DELETE_EXPIRED = text("DELETE FROM auth_tokens WHERE expires_at < now()")
+
+
+class TokenEntry(NamedTuple):
+    telegram_id: int
+    username: Optional[str]
+    expires_at: datetime
+
+
+class TokenStore:
+    """
+    Живые токены входа в памяти: token → TokenEntry и telegram_id → token (у пользователя один токен).
+
+    Истечение отслеживается хешированным колесом таймеров: токен лежит в делении
+    floor(expires_at / TOKEN_WHEEL_SLOT) % TOKEN_WHEEL_SLOTS, очистка обходит только прошедшие деления.
+    Токены, срок которых дальше одного оборота, остаются в делении до своего круга.
+    """
+
+    def __init__(self, slot_seconds: int = TOKEN_WHEEL_SLOT, slots: int = TOKEN_WHEEL_SLOTS,
+                 sweep_interval: float = TOKEN_SWEEP_INTERVAL):
+        self.slot_seconds = slot_seconds
+        self.slots = slots
+        self.sweep_interval = sweep_interval
+        self._tokens = {}
+        self._by_user = {}
+        self._wheel = [set() for _ in range(slots)]
+        self._cursor = None  # последнее обработанное деление (абсолютный номер)
+        self._task = None
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "loaded": 0,
+            "expired": 0,
+            "deleted_rows": 0,
+            "sweeps": 0,
+            "failed_sweeps": 0,
+            "last_sweep_ms": 0.0,
+        }
+
+    def _tick(self, moment: float) -> int:
+        return int(moment // self.slot_seconds)
+
+    def _slot(self, entry: TokenEntry) -> set:
+        return self._wheel[self._tick(entry.expires_at.timestamp()) % self.slots]
+
+    def put(self, token: str, telegram_id: int, username: Optional[str], expires_at: datetime):
+        """Запись токена (write-through после коммита); прежний токен пользователя вытесняется."""
+        previous = self._by_user.get(telegram_id)
+        if previous is not None and previous != token:
+            self.discard(previous)
+        self.discard(token)
+
+        entry = TokenEntry(telegram_id, username, expires_at)
+        self._tokens[token] = entry
+        self._by_user[telegram_id] = token
+        self._slot(entry).add(token)
+
+    def discard(self, token: str):
+        entry = self._tokens.pop(token, None)
+        if entry is None:
+            return
+        self._slot(entry).discard(token)
+        if self._by_user.get(entry.telegram_id) == token:
+            del self._by_user[entry.telegram_id]
+
+    def discard_user(self, telegram_id: int):
+        """Токен пользователя перевыпущен в другом процессе — прежний больше не действует."""
+        token = self._by_user.get(telegram_id)
+        if token is not None:
+            self.discard(token)
+
+    def clear(self):
+        self._tokens.clear()
+        self._by_user.clear()
+        for bucket in self._wheel:
+            bucket.clear()
+
+    def get(self, token: str, now: datetime = None) -> Optional[TokenEntry]:
+        """Действующий токен или None; просроченный удаляется сразу, не дожидаясь колеса."""
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        if entry.expires_at < (now or datetime.now(timezone.utc)):
+            self.discard(token)
+            self.metrics["expired"] += 1
+            return None
+        return entry
+
+    def expire(self, now: datetime = None) -> int:
+        """Проворачивает колесо до текущего момента и удаляет токены из полностью прошедших делений."""
+        now = now or datetime.now(timezone.utc)
+        now_tick = self._tick(now.timestamp())
+        last_tick = now_tick - 1  # текущее деление ещё не прошло целиком
+        if self._cursor is None:
+            self._cursor = last_tick
+        if self._cursor >= last_tick:
+            return 0
+
+        expired = 0
+        first_tick = max(self._cursor + 1, last_tick - self.slots + 1)  # больше оборота — каждое деление один раз
+        for tick in range(first_tick, last_tick + 1):
+            bucket = self._wheel[tick % self.slots]
+            for token in list(bucket):
+                if self._tokens[token].expires_at <= now:
+                    self.discard(token)
+                    expired += 1
+        self._cursor = last_tick
+        self.metrics["expired"] += expired
+        return expired
+
+    async def load(self, db: AsyncSession):
+        """Загружает действующие токены из auth_tokens (при старте приложения)."""
+        now = datetime.now(timezone.utc)
+        result = await db.execute(
+            select(AuthTokens.token, AuthTokens.user_id, User.username, AuthTokens.expires_at)
+            .join(User, User.telegram_id == AuthTokens.user_id)
+            .filter(AuthTokens.expires_at > now)
+        )
+        rows = result.all()
+        for token, telegram_id, username, expires_at in rows:
+            self.put(token, telegram_id, username, expires_at)
+        self._cursor = self._tick(now.timestamp()) - 1
+        self.metrics["loaded"] = len(rows)
+
+    async def sweep(self):
+        """Очистка: истёкшие токены из памяти и одним DELETE — из auth_tokens."""
+        started = time.perf_counter()
+        self.expire()
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(_DELETE_EXPIRED)
+                await db.commit()
+            self.metrics["deleted_rows"] += result.rowcount or 0
+        except Exception as e:
+            self.metrics["failed_sweeps"] += 1
+            logging.error(f"Ошибка при удалении просроченных токенов: {e}")
+        self.metrics["sweeps"] += 1
+        self.metrics["last_sweep_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            await self.sweep()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> dict:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            **self.metrics,
+            "size": len(self._tokens),
+            "hit_ratio": round(self.metrics["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+token_store = TokenStore()
+cache_bus.on("auth_token", token_store.discard)
+cache_bus.on("auth_token_user", token_store.discard_user)
+cache_bus.on_reset(token_store.clear)  # Токены подгрузятся из базы при следующем обращении
+
+
+async def validate_token(db: AsyncSession, token: str) -> Optional[TokenEntry]:
+    """
+    Действующий токен: из памяти без обращения к базе.
+
+    Промах (токен выдан другим процессом или до загрузки) проверяется одним запросом и кэшируется.
+    :return: TokenEntry или None, если токена нет или он просрочен; telegram_id None — пользователя уже нет.
+    """
+    entry = token_store.get(token)
+    if entry is not None:
+        token_store.metrics["hits"] += 1
+        return entry
+
+    token_store.metrics["misses"] += 1
+    auth = await get_auth_view(db, token)
+    if auth is None or auth.expires_at < datetime.now(timezone.utc):
+        return None
+    if auth.telegram_id is None:
+        return TokenEntry(None, None, auth.expires_at)
+
+    token_store.put(token, auth.telegram_id, auth.username, auth.expires_at)
+    return TokenEntry(auth.telegram_id, auth.username, auth.expires_at)
@@ -0,0 +1,99 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from app.models.models import User
+from app.services.cache_bus import cache_bus
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))  # секунды
+
+
+class UserRef(NamedTuple):
+    """Минимум данных о пользователе, нужный большинству эндпоинтов."""
+    id: int
+    telegram_id: int
+    plan: int
+    automod: bool
+
+
+class UserCache:
+    """LRU-кэш telegram_id → UserRef с ограниченным временем жизни записей."""
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # telegram_id -> (expires_at, UserRef)
+        self.metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, telegram_id: int):
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[telegram_id]
+            return None
+
+        self._entries.move_to_end(telegram_id)
+        return user
+
+    def put(self, user: UserRef):
+        self._entries[user.telegram_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.telegram_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.metrics["evictions"] += 1
+
+    def invalidate(self, telegram_id: int):
+        if self._entries.pop(telegram_id, None) is not None:
+            self.metrics["invalidations"] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_metrics(self) -> dict:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            **self.metrics,
+            "size": len(self._entries),
+            "hit_ratio": round(self.metrics["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+user_cache = UserCache()
+cache_bus.on("user", user_cache.invalidate)  # Изменения из других процессов
+cache_bus.on_reset(user_cache.clear)
+
+
+async def get_user_ref(db: AsyncSession, telegram_id: int):
+    """
+    Возвращает UserRef по telegram_id: из кэша или одним запросом по колонкам.
+
+    :return: UserRef или None, если пользователь не найден (отсутствие не кэшируется).
+    """
+    user = user_cache.get(telegram_id)
+    if user is not None:
+        user_cache.metrics["hits"] += 1
+        return user
+
+    user_cache.metrics["misses"] += 1
+    result = await db.execute(
+        select(User.id, User.telegram_id, User.plan, User.automod).filter(User.telegram_id == telegram_id)
+    )
+    row = result.first()
+    if row is None:
+        return None
+
+    user = UserRef(*row)
+    user_cache.put(user)
+    return user
+
+
+def invalidate_user(telegram_id: int):
+    """Сбрасывает запись пользователя после изменения его данных (план, автомод, регистрация)."""
+    user_cache.invalidate(telegram_id)
+    cache_bus.publish("user", telegram_id)
@@ -0,0 +1,111 @@
+import csv
+import io
+import os
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func
+from app.database import get_db
+from app.models.models import Balance, User
+from app.services.history import to_ndjson
+from app.services.read_models import referrer_telegram_id
+
+# Сколько строк за раз забирать из серверного курсора при выгрузке
+USER_EXPORT_CHUNK = int(os.getenv("USER_EXPORT_CHUNK", 2000))
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+_Referrer = aliased(User)
+
+# Колонки выгрузки: имя в ответе → выражение SQL
+EXPORT_COLUMNS = {
+    "id": User.id,
+    "telegram_id": User.telegram_id,
+    "username": User.username,
+    "first_name": User.first_name,
+    "last_name": User.last_name,
+    "language_code": User.language_code,
+    "is_bot": User.is_bot,
+    "photo_url": User.photo_url,
+    "automod": User.automod,
+    "plan": User.plan,
+    "in_work": User.in_work,
+    "reinvestements_par": User.reinvestements_par,
+    "auto_mode_enabled": User.auto_mode_enabled,
+    "created_at": User.created_at,
+    "updated_at": User.updated_at,
+    "balance": func.coalesce(Balance.balance, 0.0),
+    "trade_balance": func.coalesce(Balance.trade_balance, 0.0),
+    "frozen_balance": func.coalesce(Balance.frozen_balance, 0.0),
+    "earned_balance": func.coalesce(Balance.earned_balance, 0.0),
+    "referred_by_id": _Referrer.id,
+    "referred_by_telegram_id": _Referrer.telegram_id,
+    "referred_by_username": _Referrer.username,
+}
+
+
+def parse_columns(columns: str = None) -> list:
+    """Разбирает проекцию "id,telegram_id,balance"; без параметра — все колонки."""
+    if not columns:
+        return list(EXPORT_COLUMNS)
+
+    names = [name.strip() for name in columns.split(",") if name.strip()]
+    unknown = [name for name in names if name not in EXPORT_COLUMNS]
+    if unknown or not names:
+        raise HTTPException(status_code=400, detail=f"Unknown columns: {', '.join(unknown)}")
+    return names
+
+
+def build_users_query(
+    names: list,
+    plan: int = None,
+    automod: bool = None,
+    created_from: datetime = None,
+    created_to: datetime = None,
+):
+    """SELECT выбранных колонок пользователей с балансом и пригласившим (соединения только при необходимости)."""
+    query = select(*(EXPORT_COLUMNS[name].label(name) for name in names)).select_from(User)
+
+    if any(name.endswith("_balance") or name == "balance" for name in names):
+        query = query.outerjoin(Balance, Balance.user_id == User.id)
+    if any(name.startswith("referred_by_") for name in names):
+        query = query.outerjoin(_Referrer, _Referrer.telegram_id == referrer_telegram_id)
+
+    if plan is not None:
+        query = query.filter(User.plan == plan)
+    if automod is not None:
+        query = query.filter(User.automod == automod)
+    if created_from is not None:
+        query = query.filter(User.created_at >= created_from)
+    if created_to is not None:
+        query = query.filter(User.created_at < created_to)
+
+    return query.order_by(User.id)
+
+
+async def stream_users(query, names: list, export_format: str):
+    """
+    Выгрузка пользователей потоком NDJSON или CSV.
+
+    Строки читаются серверным курсором порциями по USER_EXPORT_CHUNK в собственной сессии;
+    CSV отдаётся порциями того же размера.
+    """
+    async with get_db() as db:
+        result = await db.stream(query.execution_options(yield_per=USER_EXPORT_CHUNK))
+
+        if export_format == "ndjson":
+            async for row in result.mappings():
+                yield to_ndjson(dict(row))
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(names)
+        async for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
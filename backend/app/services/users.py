@@ -1,12 +1,21 @@
 import random
+import secrets
 import string
 import logging
+from datetime import datetime
+from typing import NamedTuple, Optional
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text
 from sqlalchemy.future import select
 from sqlalchemy.exc import SQLAlchemyError
 from app.models.models import User, Referrals
 from app.database import get_db
+from app.services.user_cache import invalidate_user
+from app.services.referrals import link_referral
+from app.services.telegram_service import MOSCOW_TZ, TOKEN_EXPIRATION
+from app.services.token_store import token_store
+from app.services.signed_tokens import AUTH_MODE, issue_signed_token
 
 
 # Отключаем SQLAlchemy INFO-логи
@@ -28,6 +37,137 @@ console_handler.setFormatter(formatter)
 
 logger.addHandler(console_handler)
 
+# Стартовые балансы нового пользователя
+REGISTRATION_BALANCE = 100.0
+REGISTRATION_TRADE_BALANCE = 50.0
+
+# Регистрация одним запросом в одной транзакции. Пользователь вставляется с ON CONFLICT (telegram_id):
+# при повторном нажатии кнопки (в том числе параллельном — второй запрос ждёт первый на уникальном индексе)
+# new_user пуст, и ни реферальная запись, ни баланс, ни токен повторно не создаются.
+# Ссылка строится из users.id, поэтому уникальна без проверочных SELECT.
+_REGISTER_USER = text("""
+    WITH new_user AS (
+        INSERT INTO users (telegram_id, username, first_name, last_name, language_code, is_bot, photo_url,
+                           automod, plan, reinvestements_par, in_work, auto_mode_enabled)
+        VALUES (CAST(:telegram_id AS BIGINT), CAST(:username AS VARCHAR), CAST(:first_name AS VARCHAR),
+                CAST(:last_name AS VARCHAR), CAST(:language_code AS VARCHAR), FALSE, CAST(:photo_url AS VARCHAR),
+                FALSE, 0, 0, 0, FALSE)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING id, telegram_id
+    ),
+    ref AS (
+        SELECT u.telegram_id
+        FROM users AS u
+        WHERE u.telegram_id = CAST(:referred_by AS BIGINT)
+          AND u.telegram_id <> CAST(:telegram_id AS BIGINT)
+    ),
+    referral AS (
+        INSERT INTO referrals (user_id, telegram_id, referral_link, invited_count, referrer_id, referred_by)
+        SELECT n.id, n.telegram_id, 'https://app.com/ref/' || n.id || '-' || n.telegram_id, 0,
+               (SELECT telegram_id FROM ref), (SELECT telegram_id FROM ref)
+        FROM new_user AS n
+        RETURNING referral_link
+    ),
+    balance AS (
+        INSERT INTO balances (user_id, balance, trade_balance, frozen_balance, earned_balance)
+        SELECT n.id, CAST(:balance AS DOUBLE PRECISION), CAST(:trade_balance AS DOUBLE PRECISION), 0.0, 0.0
+        FROM new_user AS n
+        RETURNING user_id
+    ),
+    token AS (
+        INSERT INTO auth_tokens (user_id, token, expires_at, created_at)
+        SELECT n.telegram_id, CAST(:token AS VARCHAR), CAST(:expires_at AS TIMESTAMPTZ), now()
+        FROM new_user AS n
+        WHERE CAST(:token AS VARCHAR) IS NOT NULL
+        RETURNING token
+    ),
+    closure AS (
+        -- Сам пользователь и, если есть пригласивший, все его предки (у нового узла нет потомков)
+        INSERT INTO referral_closure (ancestor, descendant, depth)
+        SELECT n.telegram_id, n.telegram_id, 0 FROM new_user AS n
+        UNION ALL
+        SELECT up.ancestor, n.telegram_id, up.depth + 1
+        FROM new_user AS n
+        CROSS JOIN (
+            SELECT c.ancestor, c.depth FROM referral_closure AS c WHERE c.descendant = (SELECT telegram_id FROM ref)
+            UNION
+            SELECT telegram_id, 0 FROM ref
+        ) AS up
+        ON CONFLICT (ancestor, descendant) DO NOTHING
+        RETURNING ancestor, descendant, depth
+    ),
+    invited AS (
+        -- Пересчёт из referral_closure, как _REFRESH_INVITED_COUNT: снимок запроса ещё не видит строк closure,
+        -- поэтому к уже существующим прямым приглашённым добавляются только что вставленные
+        UPDATE referrals AS r
+        SET invited_count = (
+            SELECT count(*) FROM referral_closure AS c
+            WHERE c.ancestor = r.telegram_id AND c.depth = 1
+        ) + (
+            SELECT count(*) FROM closure AS c
+            WHERE c.ancestor = r.telegram_id AND c.depth = 1
+        )
+        WHERE r.telegram_id = (SELECT telegram_id FROM ref)
+          AND EXISTS (SELECT 1 FROM new_user)
+        RETURNING r.id
+    )
+    SELECT n.id, n.telegram_id, referral.referral_link
+    FROM new_user AS n
+    CROSS JOIN referral
+""")
+
+
+class Registration(NamedTuple):
+    user_id: int
+    telegram_id: int
+    referral_link: str
+    token: str
+
+async def register_bot_user(db: AsyncSession, chat_id: int, username: str, first_name: str, last_name: str,
+                            language_code: str, photo_url: str = None,
+                            referred_by: int = None) -> Optional[Registration]:
+    """
+    Регистрация из бота: пользователь, реферальная запись, баланс и токен входа — один запрос, один коммит.
+
+    :param referred_by: Telegram ID пригласившего (необязательно; неизвестный игнорируется).
+    :return: Registration или None, если пользователь уже зарегистрирован.
+    """
+    expires_at = datetime.now(MOSCOW_TZ) + TOKEN_EXPIRATION
+    token = None if AUTH_MODE == "signed" else secrets.token_urlsafe(32)
+
+    try:
+        result = await db.execute(_REGISTER_USER, {
+            "telegram_id": chat_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "language_code": language_code,
+            "photo_url": photo_url,
+            "referred_by": referred_by,
+            "balance": REGISTRATION_BALANCE,
+            "trade_balance": REGISTRATION_TRADE_BALANCE,
+            "token": token,
+            "expires_at": expires_at,
+        })
+        row = result.first()
+        await db.commit()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logging.error(f"Ошибка при регистрации пользователя {chat_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Ошибка при регистрации пользователя")
+
+    if row is None:
+        return None
+
+    invalidate_user(chat_id)
+    if token is None:
+        token = issue_signed_token(chat_id, username, expires_at)
+    else:
+        token_store.put(token, chat_id, username, expires_at)  # Запись в кэш токенов
+
+    return Registration(user_id=row.id, telegram_id=row.telegram_id, referral_link=row.referral_link, token=token)
+
+
 # Функция генерации уникального реферального кода
 async def generate_unique_referral_code(db: AsyncSession, user_id: int, telegram_id: int) -> str:
     while True:
@@ -76,26 +216,21 @@ async def create_referral_data(db: AsyncSession, user_id: int, referrer_id: int
                 logging.warning(f"Реферер с ID {referrer_id} не найден, запись будет создана без реферера.")
                 referrer_id = None  # Если реферера нет, оставляем поле пустым
 
-        # Создаем запись в таблице Referrals
+        # Создаем запись в таблице Referrals (referrer_id и referred_by — telegram_id пригласившего)
+        referrer_telegram_id = referrer.telegram_id if referrer else None
         new_referral = Referrals(
             user_id=user_id,
             telegram_id=user.telegram_id,
             referral_link=referral_link,
-            referrer_id=referrer_id,  # используем правильное имя поля
+            referrer_id=referrer_telegram_id,
             invited_count=0,
-            referred_by=referrer_id  # исправляем на правильное поле
+            referred_by=referrer_telegram_id
         )
 
         db.add(new_referral)
 
-        # Если есть реферер — увеличиваем ему счетчик приглашенных
-        if referrer_id:
-            referrer_referral = await db.execute(select(Referrals).filter(Referrals.user_id == referrer_id))
-            referrer_ref = referrer_referral.scalars().first()
-
-            if referrer_ref:
-                referrer_ref.invited_count += 1
-                logging.info(f"Увеличен счетчик приглашенных у пользователя {referrer_id}.")
+        # Дерево рефералов и счетчик приглашенных у реферера обновляются через referral_closure
+        await link_referral(db, user.telegram_id, referrer_telegram_id)
 
         await db.commit()
         await db.refresh(new_referral)
@@ -135,6 +270,7 @@ async def register_user(db: AsyncSession, chat_id: int, username: str, first_nam
             db.add(db_user)
             await db.commit()  # Коммитим нового пользователя
             await db.refresh(db_user)
+            invalidate_user(chat_id)
         else:
             logging.info(f"")
 
@@ -195,16 +331,12 @@ async def add_referral(db: AsyncSession, telegram_id: int, referral_link: str):
             user_id=new_user.id,           # ID нового пользователя в системе
             telegram_id=telegram_id,       # Telegram ID приглашенного
             referral_link=referral_link,   # Ссылка с реферальным кодом
-            referred_by=referrer.id        # ID пригласившего пользователя (ссылается на пользователя)
+            referred_by=referrer.telegram_id  # Telegram ID пригласившего пользователя
         )
         db.add(new_referral)
 
-        # Увеличиваем счетчик приглашенных у реферера
-        referrer_ref_result = await db.execute(select(Referrals).filter(Referrals.user_id == referrer.id))
-        referrer_ref = referrer_ref_result.scalars().first()
-
-        if referrer_ref:
-            referrer_ref.invited_count += 1
+        # Дерево рефералов и счетчик приглашенных у реферера обновляются через referral_closure
+        await link_referral(db, telegram_id, referrer.telegram_id)
 
         await db.commit()
         await db.refresh(new_referral)
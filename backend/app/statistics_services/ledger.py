@@ -0,0 +1,167 @@
+# ledger.py
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+from app.database import AsyncSessionLocal
+from app.models.models import Transaction
+
+# Режим журнала: transactional — запись в транзакции вызывающего кода, async — фоновая очередь
+LEDGER_MODE = os.getenv("LEDGER_MODE", "transactional")
+LEDGER_QUEUE_SIZE = int(os.getenv("LEDGER_QUEUE_SIZE", 10000))
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", 1.0))
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", 1000))
+
+_BUFFER_KEY = "ledger_buffer"
+
+# Метрики сброса журнала
+metrics = {
+    "mode": LEDGER_MODE,
+    "flushes": 0,
+    "rows_written": 0,
+    "failed_flushes": 0,
+    "last_flush_rows": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+}
+
+
+def _ledger_row(user_id: int, amount: float, transaction_type: str) -> dict:
+    return {
+        "user_id": user_id,
+        "amount": amount,
+        "transaction_type": transaction_type,
+        "created_at": datetime.now(timezone.utc),  # время события, а не время сброса
+    }
+
+
+def _record_flush(rows: int, started: float):
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    metrics["flushes"] += 1
+    metrics["rows_written"] += rows
+    metrics["last_flush_rows"] = rows
+    metrics["last_flush_ms"] = elapsed_ms
+    metrics["max_flush_ms"] = max(metrics["max_flush_ms"], elapsed_ms)
+
+
+def _chunks(rows: list):
+    for i in range(0, len(rows), LEDGER_BATCH_SIZE):
+        yield rows[i:i + LEDGER_BATCH_SIZE]
+
+#-------------------------------------------------------------------------#
+# Транзакционный режим: строки копятся в сессии и вставляются одним
+# многострочным INSERT непосредственно перед коммитом этой же сессии.
+
+@event.listens_for(Session, "before_commit")
+def _flush_on_commit(session: Session):
+    rows = session.info.pop(_BUFFER_KEY, None)
+    if not rows:
+        return
+
+    started = time.perf_counter()
+    for chunk in _chunks(rows):
+        session.execute(insert(Transaction).values(chunk))
+    _record_flush(len(rows), started)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session):
+    # Откат транзакции откатывает и её записи журнала
+    session.info.pop(_BUFFER_KEY, None)
+
+#-------------------------------------------------------------------------#
+# Асинхронный режим: ограниченная очередь и фоновая задача, сбрасывающая
+# накопленные строки пачками раз в LEDGER_FLUSH_INTERVAL секунд.
+# Пока неудавшаяся пачка не записана, очередь не разбирается: она заполняется,
+# и append() ждёт места — память ограничена размером очереди, строки не теряются.
+
+class AsyncLedgerWriter:
+    def __init__(self, queue_size: int = LEDGER_QUEUE_SIZE, flush_interval: float = LEDGER_FLUSH_INTERVAL):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.flush_interval = flush_interval
+        self._pending = []  # пачка, которую не удалось записать (повторяется при следующем сбросе)
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def append(self, row: dict):
+        """Добавляет строку в очередь; при заполненной очереди ждёт освобождения места."""
+        await self.queue.put(row)
+
+    async def flush(self) -> int:
+        """Записывает многострочным INSERT неудавшуюся пачку, а если её нет — всё из очереди."""
+        if not self._pending:
+            while not self.queue.empty():
+                self._pending.append(self.queue.get_nowait())
+        if not self._pending:
+            return 0
+
+        rows = self._pending
+        started = time.perf_counter()
+        try:
+            async with AsyncSessionLocal() as db:
+                for chunk in _chunks(rows):
+                    await db.execute(insert(Transaction).values(chunk))
+                await db.commit()
+        except Exception as e:
+            metrics["failed_flushes"] += 1
+            logging.error(
+                f"Ошибка при записи журнала транзакций ({len(rows)} строк, повтор при следующем сбросе; "
+                f"в очереди {self.queue.qsize()}): {e}"
+            )
+            return 0
+
+        self._pending = []
+        _record_flush(len(rows), started)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def stop(self):
+        """Останавливает фоновую задачу и дописывает всё, что осталось в очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while await self.flush():  # после повтора неудавшейся пачки в очереди могли остаться строки
+            pass
+        if self._pending or not self.queue.empty():
+            logging.error(f"При остановке не удалось записать {self.queue_depth()} строк журнала транзакций")
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize() + len(self._pending)
+
+
+async_writer = AsyncLedgerWriter()
+
+#-------------------------------------------------------------------------#
+
+async def log_transactions(db, rows: list):
+    """
+    Добавляет пачку записей журнала.
+
+    :param db: Асинхронная сессия SQLAlchemy (в транзакционном режиме строки запишутся при её коммите).
+    :param rows: Список словарей с ключами user_id, amount, transaction_type.
+    """
+    rows = [_ledger_row(r["user_id"], r["amount"], r["transaction_type"]) for r in rows]
+
+    if LEDGER_MODE == "async":
+        for row in rows:
+            await async_writer.append(row)
+    else:
+        db.info.setdefault(_BUFFER_KEY, []).extend(rows)
+
+
+def get_metrics() -> dict:
+    return {**metrics, "queue_depth": async_writer.queue_depth()}
@@ -1,14 +1,13 @@
+import asyncio
 import os
 import logging
 from dotenv import load_dotenv
 from fastapi import HTTPException
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from telegram.ext import Application, CommandHandler, CallbackContext, CallbackQueryHandler
-from app.services.balances import create_or_update_balance
 from app.database import get_db
-from app.services.users import register_user, create_referral_data
-from app.routers.general_routes import get_user_by_telegram_id
-from app.services.telegram_service import generate_auth_token
+from app.services.users import register_bot_user
+from app.services.advisory_lock import AdvisoryLock
 
 # Загружаем переменные из .env
 dotenv_path = os.path.join(os.path.dirname(__file__), '..', 'app', '.env')
@@ -40,6 +39,22 @@ if not TELEGRAM_API_TOKEN:
 # URL вашего сайта
 WEBSITE_URL = "https://signals-bot.com"
 
+# Получение обновлений: polling — long polling (один опрашивающий процесс на все воркеры),
+# webhook — Telegram присылает обновления на BOT_WEBHOOK_PATH, off — бот в этом процессе не запускается
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", f"{WEBSITE_URL}/api/telegram/webhook")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", 64))  # обновлений, обрабатываемых одновременно
+BOT_POLLER_LOCK_KEY = int(os.getenv("BOT_POLLER_LOCK_KEY", 7402311))  # ключ advisory-блокировки опрашивающего процесса
+BOT_POLLER_RETRY = float(os.getenv("BOT_POLLER_RETRY", 30))  # секунды между попытками взять блокировку
+
+# Без секрета любой, кто достучится до маршрута вебхука, сможет подделать обновления
+if BOT_MODE == "webhook" and not BOT_WEBHOOK_SECRET:
+    raise ValueError("BOT_WEBHOOK_SECRET не задан в .env файле, а BOT_MODE=webhook!")
+
+# Приложение бота текущего процесса (создаётся в main)
+application = None
+
 # Функция для обработки команды /start
 async def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user  # Берем данные пользователя
@@ -96,24 +111,20 @@ async def register(update: Update, context: CallbackContext) -> None:
     try:
         async with get_db() as db:
             try:
-                db_user = await get_user_by_telegram_id(chat_id, db)
+                # Пользователь, реферальная запись, баланс и токен — одной транзакцией; повторное нажатие ничего не создаёт
+                registration = await register_bot_user(
+                    db, chat_id, username, first_name, last_name, language_code, photo_url
+                )
 
-                if isinstance(db_user, dict):
-                    db_user = await register_user(db, chat_id, username, first_name, last_name, language_code, photo_url)
-                    user_id = db_user.id
-                    referral_data = await create_referral_data(db, user_id)
-                    await create_or_update_balance(db, user_id, balance=100.0, trade_balance=50.0)
-
-                    # Генерация токена для аутентификации
-                    token = await generate_auth_token(db, db_user.telegram_id)
-                    auth_url = f"{WEBSITE_URL}/auth?token={token}"
+                if registration:
+                    auth_url = f"{WEBSITE_URL}/auth?token={registration.token}"
 
                     keyboard = [[InlineKeyboardButton("Открыть мини-приложение", web_app=WebAppInfo(url=auth_url))]]
                     reply_markup = InlineKeyboardMarkup(keyboard)
 
                     await message.reply_text(
                         f"Привет, {first_name}! Ты успешно зарегистрирован.\n\n"
-                        f"Твоя реферальная ссылка: {referral_data.referral_link}\n\n"
+                        f"Твоя реферальная ссылка: {registration.referral_link}\n\n"
                         "Теперь ты можешь использовать наше мини-приложение!",
                         reply_markup=reply_markup
                     )
@@ -151,23 +162,69 @@ async def back_to_start(update: Update, context: CallbackContext) -> None:
     await start(update, context)  # Передаем сам update, а не message
 
 
-# Функция для запуска бота
-async def main() -> None:
-    application = Application.builder().token(TELEGRAM_API_TOKEN).build()
-    
+def build_application() -> Application:
+    builder = Application.builder().token(TELEGRAM_API_TOKEN).concurrent_updates(BOT_CONCURRENT_UPDATES)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)  # Обновления кладёт в очередь маршрут вебхука
+    bot_application = builder.build()
+
     # Обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("register", register))
-    
+    bot_application.add_handler(CommandHandler("start", start))
+    bot_application.add_handler(CommandHandler("register", register))
+
     # Обработчики кнопок
-    application.add_handler(CallbackQueryHandler(description, pattern="description"))
-    application.add_handler(CallbackQueryHandler(register, pattern="register"))
-    application.add_handler(CallbackQueryHandler(start_app, pattern="start_app"))
-    application.add_handler(CallbackQueryHandler(back_to_start, pattern="back_to_start"))
-    
-    # Запуск бота
-    await application.run_polling()
+    bot_application.add_handler(CallbackQueryHandler(description, pattern="description"))
+    bot_application.add_handler(CallbackQueryHandler(register, pattern="register"))
+    bot_application.add_handler(CallbackQueryHandler(start_app, pattern="start_app"))
+    bot_application.add_handler(CallbackQueryHandler(back_to_start, pattern="back_to_start"))
+    return bot_application
+
+
+async def feed_update(data: dict) -> bool:
+    """Кладёт обновление из вебхука в очередь приложения; False — бот в этом процессе не запущен."""
+    if application is None or not application.running:
+        return False
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return True
+
+
+async def wait_for_poller_lock(lock: AdvisoryLock):
+    """Опрашивать Telegram может только один процесс: остальные ждут, пока блокировка освободится."""
+    while not await lock.try_acquire():
+        await asyncio.sleep(BOT_POLLER_RETRY)
+
+
+# Функция для запуска бота
+async def main() -> None:
+    """Запуск бота в текущем event loop; при отмене задачи бот корректно останавливается."""
+    global application
+    if BOT_MODE == "off":
+        return
+
+    application = build_application()
+    lock = AdvisoryLock(BOT_POLLER_LOCK_KEY)
+    await application.initialize()
+    await application.start()
+    try:
+        if BOT_MODE == "webhook":
+            # Регистрирует вебхук один процесс; принимают обновления все воркеры
+            if await lock.try_acquire():
+                await application.bot.set_webhook(
+                    BOT_WEBHOOK_URL, secret_token=BOT_WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+                )
+                await lock.release()
+        else:
+            await wait_for_poller_lock(lock)
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+        await asyncio.Event().wait()  # Работаем до отмены задачи при остановке приложения
+    finally:
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await lock.release()
+
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
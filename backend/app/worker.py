@@ -0,0 +1,71 @@
+"""
+Запуск одной роли в отдельном процессе (каждая со своим пулом соединений DB_<ROLE>_POOL_SIZE):
+
+    python -m app.worker api        # HTTP API (uvicorn, API_WORKERS воркеров)
+    python -m app.worker bot        # Telegram бот; при BOT_MODE=webhook — с маршрутом вебхука на BOT_WEBHOOK_PORT
+    python -m app.worker scheduler  # Обработка сигналов, автомод, статичные сигналы
+
+Кэши процессов согласуются через PostgreSQL LISTEN/NOTIFY (app.services.cache_bus).
+Без аргумента и APP_ROLE=all всё работает в одном процессе, как раньше: uvicorn app.main:app.
+"""
+import asyncio
+import os
+import signal
+import sys
+
+WORKER_ROLES = ("api", "bot", "scheduler")
+
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", 8000))
+API_WORKERS = int(os.getenv("API_WORKERS", 1))
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", 8001))
+
+
+async def run_role():
+    """Фоновые задачи роли до SIGTERM/SIGINT."""
+    import uvicorn
+    from fastapi import FastAPI
+    from app.lifecycle import start_services, stop_services
+    from app.roles import APP_ROLE
+    from app.telegram_bot import BOT_MODE
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await start_services()
+    server = None
+    if APP_ROLE == "bot" and BOT_MODE == "webhook":
+        # Обновления Telegram принимает процесс бота, а не API
+        from app.routers import telegram_webhook
+        webhook_app = FastAPI()
+        webhook_app.include_router(telegram_webhook.router)
+        server = uvicorn.Server(uvicorn.Config(webhook_app, host=API_HOST, port=BOT_WEBHOOK_PORT))
+        server_task = asyncio.create_task(server.serve())
+        server_task.add_done_callback(lambda _: stop.set())  # uvicorn мог сам перехватить SIGTERM
+
+    try:
+        await stop.wait()
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await server_task
+        await stop_services()
+
+
+def main():
+    role = sys.argv[1] if len(sys.argv) > 1 else os.getenv("APP_ROLE")
+    if role not in WORKER_ROLES:
+        sys.exit(f"Использование: python -m app.worker {{{'|'.join(WORKER_ROLES)}}}")
+    os.environ["APP_ROLE"] = role  # До импорта app.database: размер пула зависит от роли
+
+    if role == "api":
+        import uvicorn
+        uvicorn.run("app.main:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
+    else:
+        asyncio.run(run_role())
+
+
+if __name__ == "__main__":
+    main()
@@ -79,11 +79,11 @@ export default function Signals() {
                 <div className="space-x-2 grid grid-cols-3">
                     <div className="bg-blue-200 rounded-3xl flex items-center justify-center flex-col">
                         <p>{t("risk")}:</p>
-                        {(signal.burn_chance * 100).toFixed(2)}%        
+                        {signal.burn_chance.toFixed(2)}%        
                     </div>
                     <div className="bg-blue-200 rounded-3xl flex items-center justify-center flex-col">
                         <p>{t("profit")}:</p>   
-                        {(signal.profit_percent * 100).toFixed(2)}%       
+                        {signal.profit_percent.toFixed(2)}%       
                     </div>
                     <div className="bg-blue-200 rounded-3xl flex items-center justify-center flex-col">
                         <p>{t("time")}:</p>
@@ -91,7 +91,7 @@ export default function Signals() {
                     </div>
                 </div>
                 <div className="text-start text-xs">
-                    {t("ecprofit")} ≈ {profits?.amount === undefined ? '0' : (((profits.amount * signal.profit_percent) * 100).toFixed(2))}%
+                    {t("ecprofit")} ≈ {profits?.amount === undefined ? '0' : ((profits.amount * signal.profit_percent).toFixed(2))}%
                 </div>
             </Card>
             )